@@ -1,10 +1,104 @@
+import operator
+import os
 import pprint
 import ipdb
 
+# The examples time small inputs, set BENCH=1 to time the big ones too
+BENCH = bool(os.environ.get('BENCH'))
+
+
+"""
+Classes with `__slots__` have no `__dict__`, or have one only for the
+attributes that aren't slots. `instance_fields` gives the attributes of any
+instance as a dict: the slots that were assigned, then the `__dict__`.
+Only classes that set `_fields_from_slots` (the mixins below do) have their
+slots read this way, other slotted values like `Fraction` or `IPv4Address`
+keep their private slots to themselves and are left as they are.
+"""
+_slot_layouts = {}
+
+
+def _slot_layout(cls):
+    layout = _slot_layouts.get(cls)
+    if layout is None:
+        names = []
+        # Classes that don't opt in get no layout, which keeps them on the
+        # plain `__dict__` path
+        mro = cls.__mro__ if getattr(cls, '_fields_from_slots', False) else ()
+        for klass in reversed(mro):
+            if not klass.__dict__.get('_serialize_slots', True):
+                continue  # The class uses its slots for bookkeeping
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            for name in slots:
+                if name in ('__dict__', '__weakref__'):
+                    continue
+                if name.startswith('__') and not name.endswith('__'):
+                    name = f"_{klass.__name__.lstrip('_')}{name}"  # mangled
+                if name not in names:
+                    names.append(name)
+        # The getter reads every slot in one call, always returning a tuple
+        getter = operator.attrgetter(*names, *names[:1]) if names else None
+        layout = _slot_layouts[cls] = (tuple(names), getter)
+    return layout
+
+
+def instance_fields(value):
+    layout = _slot_layouts.get(type(value))
+    if layout is None:
+        layout = _slot_layout(type(value))
+    slot_names, getter = layout
+    if not slot_names:
+        return value.__dict__
+    try:
+        fields = dict(zip(slot_names, getter(value)))
+    except AttributeError:
+        # Some slot was never assigned
+        fields = {}
+        for name in slot_names:
+            try:
+                fields[name] = getattr(value, name)
+            except AttributeError:
+                pass
+    if hasattr(value, '__dict__'):
+        fields.update(value.__dict__)
+    return fields
+
+
+def instance_items(value):
+    # Like instance_fields(value).items() without building the dict when the
+    # instance only has slots
+    layout = _slot_layouts.get(type(value))
+    if layout is None:
+        layout = _slot_layout(type(value))
+    slot_names, getter = layout
+    if not slot_names:
+        return value.__dict__.items()
+    if hasattr(value, '__dict__'):
+        return instance_fields(value).items()
+    try:
+        return zip(slot_names, getter(value))
+    except AttributeError:
+        return instance_fields(value).items()
+
+
+def has_fields(value):
+    return hasattr(value, '__dict__') or bool(_slot_layout(type(value))[0])
+
+
+# Returned as they are by _traverse before any other check
+_plain_types = frozenset({str, int, float, bool, type(None)})
+
 
 class ToDictMixin:
+    __slots__ = ()
+    _fields_from_slots = True
+
     def to_dict(self):
-        return self._traverse_dict(self.__dict__)
+        if not (_slot_layouts.get(type(self)) or _slot_layout(type(self)))[0]:
+            return self._traverse_dict(self.__dict__)
+        return self._traverse_dict(instance_fields(self))
 
     """
     The following method relies on dynamic attribute access using `hasattr`,
@@ -18,14 +112,18 @@ class ToDictMixin:
         return output
 
     def _traverse(self, key, value):
-        if isinstance(value, ToDictMixin):
+        if type(value) in _plain_types:
+            return value
+        elif isinstance(value, ToDictMixin):
             return value.to_dict()
         elif isinstance(value, dict):
             return self._traverse_dict(value)
         elif isinstance(value, list):
             return [self._traverse(key, i) for i in value]
         elif hasattr(value, '__dict__'):
-            return self._traverse_dict(value.__dict__)
+            return self._traverse_dict(instance_fields(value))
+        elif (_slot_layouts.get(type(value)) or _slot_layout(type(value)))[0]:
+            return self._traverse_dict(instance_fields(value))
         else:
             return value
 
@@ -101,6 +199,9 @@ import json
 
 
 class JsonMixin:
+    __slots__ = ()
+    _fields_from_slots = True
+
     @classmethod
     def from_json(cls, data):
         kwargs = json.loads(data)
@@ -148,3 +249,1933 @@ roundtrip = deserialized.to_json()
 assert json.loads(serialized) == json.loads(roundtrip)
 print("Assertion Passed")
 
+
+
+import gc
+import time
+
+
+def best_time(func, repeat=5):
+    # The GC kicking in halfway through a run makes the numbers noisy
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+"""
+`ToDictMixin._traverse` runs the whole `isinstance`/`hasattr` chain for every
+value of every node on every call. The answer only depends on the type of the
+value, so we can run the chain once per type and keep the resulting encoder.
+
+On top of that every class gets a `SerializationPlan` the first time one of
+its instances is serialized: its fields plus the encoder picked for each
+field (per type of value seen in it). Later calls just run the plan. A plan
+is thrown away when the class changes in a way that affects serialization
+(a new `_traverse` or a new MRO).
+"""
+def _encode_scalar(owner, key, value):
+    return value
+
+
+def _encode_mixin(owner, key, value):
+    return value.to_dict()
+
+
+def _encode_dict(owner, key, value):
+    return owner._traverse_dict(value)
+
+
+def _encode_list(owner, key, value):
+    traverse = owner._traverse
+    return [traverse(key, item) for item in value]
+
+
+def _encode_object(owner, key, value):
+    return owner._traverse_dict(instance_fields(value))
+
+
+_encoders = {}
+
+
+def _encoder_for(value):
+    value_type = type(value)
+    encoder = _encoders.get(value_type)
+    if encoder is None:
+        # Same order of checks as ToDictMixin._traverse, done once per type
+        if isinstance(value, ToDictMixin):
+            encoder = _encode_mixin
+        elif isinstance(value, dict):
+            encoder = _encode_dict
+        elif isinstance(value, list):
+            encoder = _encode_list
+        elif has_fields(value):
+            encoder = _encode_object
+        else:
+            encoder = _encode_scalar
+        _encoders[value_type] = encoder
+    return encoder
+
+
+class SerializationPlan:
+    __slots__ = ('mro', 'traverse', 'fields')
+
+    def __init__(self, cls):
+        self.mro = cls.__mro__
+        self.traverse = cls._traverse
+        # field name -> {value type -> encoder}, a field like `left` usually
+        # holds either None or a subtree so it ends up with two encoders
+        self.fields = {}
+
+    def add_encoder(self, key, value):
+        if self.traverse is not CompiledToDictMixin._traverse:
+            # The class customizes `_traverse` (BinaryTreeWithParentFixed
+            # does) so every field has to go through it.
+            encoder = self.traverse
+        else:
+            encoder = _encoder_for(value)
+        self.fields.setdefault(key, {})[type(value)] = encoder
+        return encoder
+
+
+class CompiledToDictMixin(ToDictMixin):
+    __slots__ = ()
+    _plans = {}
+
+    def to_dict(self):
+        cls = type(self)
+        plan = CompiledToDictMixin._plans.get(cls)
+        if (plan is None
+                or plan.mro is not cls.__mro__
+                or plan.traverse is not cls._traverse):
+            plan = CompiledToDictMixin._plans[cls] = SerializationPlan(cls)
+
+        fields = plan.fields
+        output = {}
+        for key, value in instance_items(self):
+            try:
+                encoder = fields[key][type(value)]
+            except KeyError:
+                encoder = plan.add_encoder(key, value)
+            if encoder is _encode_scalar:
+                output[key] = value
+            elif encoder is _encode_mixin:
+                output[key] = value.to_dict()
+            else:
+                output[key] = encoder(self, key, value)
+        return output
+
+    def _traverse(self, key, value):
+        return _encoder_for(value)(self, key, value)
+
+    @classmethod
+    def invalidate_plans(cls):
+        # For changes the plans can't detect by themselves
+        CompiledToDictMixin._plans.clear()
+        _encoders.clear()
+
+
+class CompiledBinaryTree(CompiledToDictMixin):
+    def __init__(self, value, left=None, right=None):
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+class CompiledBinaryTreeWithParentFixed(CompiledBinaryTree):
+    def __init__(self, value, left=None, right=None, parent=None):
+        super().__init__(value, left=left, right=right)
+        self.parent = parent
+
+    def _traverse(self, key, value):
+        if (isinstance(value, CompiledBinaryTreeWithParentFixed) and key == 'parent'):
+            return value.value  # prevent cycles
+        else:
+            return super()._traverse(key, value)
+
+
+class CompiledSwitch(CompiledToDictMixin, Switch):
+    pass
+
+
+class CompiledMachine(CompiledToDictMixin, Machine):
+    pass
+
+
+class CompiledDatacenterRack(CompiledToDictMixin, DatacenterRack):
+    def __init__(self, switch=None, machines=None):
+        self.switch = CompiledSwitch(**switch)
+        self.machines = [
+            CompiledMachine(**kwargs) for kwargs in machines
+        ]
+
+
+def build_complete_tree(tree_cls, depth, start=0):
+    # Built bottom-up so we don't need recursion to make deep trees
+    level = [tree_cls(start + i) for i in range(2 ** depth)]
+    while len(level) > 1:
+        level = [
+            tree_cls(left.value, left=left, right=right)
+            for left, right in zip(level[::2], level[1::2])
+        ]
+    return level[0]
+
+
+def build_chain(tree_cls, length):
+    node = tree_cls(length - 1)
+    for value in range(length - 2, -1, -1):
+        node = tree_cls(value, right=node)
+    return node
+
+
+def build_rack_data(machine_count):
+    return {
+        "switch": {"ports": 48, "speed": 1e9},
+        "machines": [
+            {"cores": 2 ** (i % 6), "ram": (i % 64) * 1e9, "disk": (i % 10) * 1e12}
+            for i in range(machine_count)
+        ],
+    }
+
+
+print()
+print("### Example 6 Compiled serialization plans ###")
+root = CompiledBinaryTreeWithParentFixed(10)
+root.left = CompiledBinaryTreeWithParentFixed(7, parent=root)
+root.left.right = CompiledBinaryTreeWithParentFixed(9, parent=root.left)
+pprint.pprint(root.to_dict())
+
+for depth in [12, 15] if BENCH else [10, 12]:
+    tree = build_complete_tree(BinaryTree, depth)
+    compiled_tree = build_complete_tree(CompiledBinaryTree, depth)
+    assert tree.to_dict() == compiled_tree.to_dict()
+    before = best_time(tree.to_dict)
+    after = best_time(compiled_tree.to_dict)
+    print(f"deep BinaryTree (depth {depth}): _traverse {before * 1e3:.1f} ms, "
+          f"plan {after * 1e3:.1f} ms, {before / after:.2f}x")
+
+chain = build_chain(BinaryTree, 250)
+compiled_chain = build_chain(CompiledBinaryTree, 250)
+assert chain.to_dict() == compiled_chain.to_dict()
+
+for machine_count in [10_000, 100_000] if BENCH else [1000, 10_000]:
+    rack_data = build_rack_data(machine_count)
+    rack = DatacenterRack(**rack_data)
+    compiled_rack = CompiledDatacenterRack(**rack_data)
+    assert rack.to_dict() == compiled_rack.to_dict() == rack_data
+    before = best_time(rack.to_dict)
+    after = best_time(compiled_rack.to_dict)
+    print(f"wide DatacenterRack ({machine_count} machines): _traverse "
+          f"{before * 1e3:.1f} ms, plan {after * 1e3:.1f} ms, {before / after:.2f}x")
+
+# Patching the class makes the cached plan stale, it gets recompiled
+CompiledMachine._traverse = lambda self, key, value: str(value)
+assert CompiledMachine(cores=1, ram=2, disk=3).to_dict() == {"cores": "1", "ram": "2", "disk": "3"}
+del CompiledMachine._traverse
+assert CompiledMachine(cores=1, ram=2, disk=3).to_dict() == {"cores": 1, "ram": 2, "disk": 3}
+print("Plan invalidation Passed")
+
+
+"""
+`to_dict` recurses once per level, so a degenerate tree of a few thousand
+nodes is enough to hit `RecursionError`, and cycles are only avoided by the
+`key == 'parent'` special case in `BinaryTreeWithParentFixed`.
+
+`IterativeToDictMixin` walks the graph with an explicit stack instead, and
+remembers every container it has written by `id()`. When an object shows up
+again it's written as a back-reference, `{"$ref": "#/left/right"}`, a JSON
+pointer to the place where it was first written. With
+`share_references=False` only cycles become references and shared subtrees
+are written out again.
+
+Custom `_traverse` methods are not called, the stack replaces them.
+"""
+def _pointer_token(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _pointer(pointers, locations, value_id):
+    # Walk up until we find an ancestor whose pointer we already built, then
+    # build (and remember) the pointers on the way back down.
+    missing = []
+    while value_id not in pointers:
+        missing.append(value_id)
+        value_id = locations[value_id][0]
+    pointer = pointers[value_id]
+    for value_id in reversed(missing):
+        pointer = f"{pointer}/{_pointer_token(locations[value_id][1])}"
+        pointers[value_id] = pointer
+    return pointer
+
+
+_FINISHED = object()
+
+
+class IterativeToDictMixin(ToDictMixin):
+    __slots__ = ()
+
+    def to_dict(self, share_references=True):
+        output = {}
+        self_id = id(self)
+        # id -> (id of the container it was found in, key in that container)
+        locations = {self_id: (None, None)}
+        pointers = {self_id: '#'}
+        stack = [(output, key, value, self_id)
+                 for key, value in reversed(instance_fields(self).items())]
+
+        while stack:
+            container, key, value, parent_id = stack.pop()
+            if container is _FINISHED:
+                # Everything under `value` was written, it's no longer an
+                # ancestor of what comes next.
+                del locations[key]
+                pointers.pop(key, None)
+                continue
+
+            encoder = _encoder_for(value)
+            if encoder is _encode_scalar:
+                container[key] = value
+                continue
+
+            value_id = id(value)
+            if value_id in locations:
+                pointer = _pointer(pointers, locations, value_id)
+                container[key] = {'$ref': pointer}
+                continue
+            locations[value_id] = (parent_id, key)
+            if not share_references:
+                stack.append((_FINISHED, value_id, None, None))
+
+            if encoder is _encode_list:
+                child = [None] * len(value)
+                stack.extend(
+                    (child, index, value[index], value_id)
+                    for index in range(len(value) - 1, -1, -1)
+                )
+            else:
+                child = {}
+                items = value if encoder is _encode_dict else instance_fields(value)
+                stack.extend(
+                    (child, item_key, item, value_id)
+                    for item_key, item in reversed(items.items())
+                )
+            container[key] = child
+
+        return output
+
+
+class IterativeBinaryTree(IterativeToDictMixin, BinaryTree):
+    pass
+
+
+class IterativeBinaryTreeWithParent(IterativeToDictMixin, BinaryTreeWithParent):
+    pass
+
+
+def build_tree_with_parents(tree_cls, depth):
+    root = build_complete_tree(tree_cls, depth)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in (node.left, node.right):
+            if child is not None:
+                child.parent = node
+                stack.append(child)
+    return root
+
+
+print()
+print("### Example 7 Iterative to_dict with back-references ###")
+root = IterativeBinaryTreeWithParent(10)
+root.left = IterativeBinaryTreeWithParent(7, parent=root)
+root.left.right = IterativeBinaryTreeWithParent(9, parent=root.left)
+pprint.pprint(root.to_dict())
+
+shared = IterativeBinaryTree(3)
+pair = IterativeBinaryTree(1, left=shared, right=shared)
+print("Shared subtree as a reference:", pair.to_dict())
+print("Shared subtree written twice:", pair.to_dict(share_references=False))
+
+chain = build_chain(IterativeBinaryTree, 100_000)
+node = chain.to_dict()
+depth = 0
+while node['right'] is not None:
+    node = node['right']
+    depth += 1
+print(f"Degenerate tree with {depth + 1} nodes serialized, last value is {node['value']}")
+
+tree = build_complete_tree(BinaryTree, 10)
+iterative_tree = build_complete_tree(IterativeBinaryTree, 10)
+assert tree.to_dict() == iterative_tree.to_dict()
+
+# The time per node stays flat as the tree grows
+for depth in [13, 14, 15, 16] if BENCH else [10, 11, 12]:
+    tree = build_tree_with_parents(IterativeBinaryTreeWithParent, depth)
+    elapsed = best_time(tree.to_dict, repeat=1)
+    nodes = 2 ** (depth + 1) - 1
+    print(f"BinaryTreeWithParent with {nodes} nodes: {elapsed:.2f} s, "
+          f"{elapsed / nodes * 1e6:.2f} us/node")
+del tree
+
+
+"""
+`JsonMixin.to_json` builds the whole nested dict with `to_dict` and then the
+whole string with `json.dumps`, so for a big rack we hold the objects, the
+dicts and the text at the same time.
+
+`StreamingJsonMixin.to_json_stream` walks the objects with an explicit stack
+of iterators and writes the JSON text to `fp` every `chunk_size` characters.
+The only things kept in memory are the stack (one iterator per level) and the
+current chunk. The text is the same `to_json` produces: same separators,
+same escaping (`ensure_ascii`) and the same float formatting as `json.dumps`.
+
+Like `to_json` it doesn't protect against cycles, and like
+`IterativeToDictMixin` it doesn't call custom `_traverse` methods.
+"""
+from json.encoder import encode_basestring_ascii
+
+
+def _json_float(value):
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _json_scalar(value):
+    # Same output as json.dumps for each type, checked in the same order
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    elif value is None:
+        return 'null'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, int):
+        return int.__repr__(value)
+    elif isinstance(value, float):
+        return _json_float(value)
+    return json.dumps(value)  # tuples and anything json knows how to handle
+
+
+def _key_str(key):
+    # The str json.dumps turns a dict key into
+    if isinstance(key, str):
+        pass
+    elif isinstance(key, float):
+        key = _json_float(key)
+    elif key is True:
+        key = 'true'
+    elif key is False:
+        key = 'false'
+    elif key is None:
+        key = 'null'
+    elif isinstance(key, int):
+        key = int.__repr__(key)
+    else:
+        raise TypeError(f'keys must be str, int, float, bool or None, '
+                        f'not {key.__class__.__name__}')
+    return key
+
+
+def _json_key(key):
+    return encode_basestring_ascii(_key_str(key))
+
+
+class StreamingJsonMixin(JsonMixin):
+    __slots__ = ()
+    # The field `from_json_stream` yields items from, and their class
+    stream_field = None
+    stream_item_class = None
+
+    @classmethod
+    def from_json_stream(cls, fp, batch_size=None, lines=False,
+                         read_size=64 * 1024):
+        return JsonStreamLoader(fp, cls, cls.stream_field,
+                                cls.stream_item_class, batch_size=batch_size,
+                                lines=lines, read_size=read_size)
+
+    def to_json_stream(self, fp, chunk_size=64 * 1024):
+        chunk = ['{']
+        chunk_length = 1
+        # Each level is the iterator over its items and whether it's a dict
+        stack = [(iter(instance_fields(self).items()), True)]
+        first = True
+
+        while stack:
+            items, is_dict = stack[-1]
+            item = next(items, _FINISHED)
+            if item is _FINISHED:
+                stack.pop()
+                fragment = '}' if is_dict else ']'
+                first = False
+            else:
+                if is_dict:
+                    key, value = item
+                    prefix = _json_key(key) + ': '
+                else:
+                    value = item
+                    prefix = ''
+                if not first:
+                    prefix = ', ' + prefix
+
+                encoder = _encoder_for(value)
+                if encoder is _encode_scalar:
+                    fragment = prefix + _json_scalar(value)
+                    first = False
+                elif encoder is _encode_list:
+                    fragment = prefix + '['
+                    stack.append((iter(value), False))
+                    first = True
+                else:
+                    fragment = prefix + '{'
+                    items = value if encoder is _encode_dict else instance_fields(value)
+                    stack.append((iter(items.items()), True))
+                    first = True
+
+            chunk.append(fragment)
+            chunk_length += len(fragment)
+            if chunk_length >= chunk_size:
+                fp.write(''.join(chunk))
+                chunk = []
+                chunk_length = 0
+
+        fp.write(''.join(chunk))
+
+
+class StreamingDatacenterRack(StreamingJsonMixin, DatacenterRack):
+    stream_field = 'machines'
+    stream_item_class = Machine
+
+
+class StreamingBinaryTree(StreamingJsonMixin, BinaryTree):
+    pass
+
+
+print()
+print("### Example 8 Streaming to_json ###")
+import io
+import tracemalloc
+
+tree = StreamingBinaryTree(
+    'raíz "10"',
+    left=StreamingBinaryTree(float('nan'), right=StreamingBinaryTree(-0.0)),
+    right=StreamingBinaryTree({1: [True, None], 2.5: (), None: {}}),
+)
+output = io.StringIO()
+tree.to_json_stream(output, chunk_size=8)
+assert output.getvalue() == tree.to_json()
+print(output.getvalue())
+
+rack = StreamingDatacenterRack.from_json(serialized)
+output = io.StringIO()
+rack.to_json_stream(output)
+assert output.getvalue() == rack.to_json()
+print("Same output as to_json Passed")
+
+machine_count = 50_000 if BENCH else 5000
+rack = StreamingDatacenterRack(**build_rack_data(machine_count))
+with open(os.devnull, 'w') as devnull:
+    for label, dump in [
+        ("to_json", lambda: devnull.write(rack.to_json())),
+        ("to_json_stream", lambda: rack.to_json_stream(devnull)),
+    ]:
+        tracemalloc.start()
+        dump()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label} with {machine_count} machines: peak {peak / 2 ** 20:.1f} MiB")
+del rack
+
+
+"""
+`JsonMixin.from_json` needs the whole document as a string, `json.loads`
+turns it into dicts and `DatacenterRack.__init__` makes every `Machine`
+before we get to see the first one.
+
+`JsonStreamLoader` reads the file in chunks and parses one value at a time
+with `JSONDecoder.raw_decode`. The values of the fields are parsed whole,
+except for the list field (`machines`), whose items are turned into objects
+and yielded one by one, or in lists of `batch_size`. The rack itself is built
+as a shell with an empty list, as soon as all its other fields were read.
+Documents written by `to_json`/`to_json_stream` have `switch` first, so the
+shell is ready before the first machine; otherwise it's built at the end.
+A field that comes after the list once the shell is built is an error, as
+is anything after the document. `mb_per_second` only counts the time spent
+parsing, not the time the caller takes between items.
+
+With `lines=True` the input is JSON Lines instead: the first line is the
+rack and every other line is an item. Items already in the first line's
+list field come first. In either format a `null` list field means no items.
+"""
+import codecs
+import inspect
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class JsonStreamLoader:
+    def __init__(self, fp, cls, list_field, item_cls, batch_size=None,
+                 lines=False, read_size=64 * 1024):
+        self.fp = fp
+        self.cls = cls
+        self.list_field = list_field
+        self.item_cls = item_cls
+        self.batch_size = batch_size
+        self.lines = lines
+        self.read_size = read_size
+        self.rack = None
+        self.bytes_read = 0
+        self.elapsed = 0.0
+        self._fields = {}
+        self._required = set(inspect.signature(cls).parameters) - {list_field}
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._decode = None
+
+    @property
+    def mb_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed / 1e6
+
+    def __iter__(self):
+        items = self._iter_lines() if self.lines else self._iter_document()
+        if self.batch_size is not None:
+            items = self._batches(items)
+        # Only the parsing counts, not what the caller does between items
+        start = time.perf_counter()
+        try:
+            for item in items:
+                self.elapsed += time.perf_counter() - start
+                start = None
+                yield item
+                start = time.perf_counter()
+        finally:
+            if start is not None:
+                self.elapsed += time.perf_counter() - start
+
+    def _batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _build_rack(self):
+        self.rack = self.cls(**self._fields, **{self.list_field: []})
+
+    def _iter_lines(self):
+        for line in self.fp:
+            if isinstance(line, bytes):
+                self.bytes_read += len(line)
+                line = line.decode('utf-8')
+            else:
+                self.bytes_read += len(line)
+            if not line.strip():
+                continue
+            kwargs = json.loads(line)
+            if self.rack is None:
+                items = kwargs.pop(self.list_field, None) or []
+                self._fields = kwargs
+                self._build_rack()
+                for item in items:
+                    yield self.item_cls(**item)
+            else:
+                yield self.item_cls(**kwargs)
+
+    def _iter_document(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._position += 1
+        else:
+            while True:
+                key = self._value()
+                self._expect(':')
+                if key == self.list_field and self._peek() == '[':
+                    if self._required <= self._fields.keys():
+                        self._build_rack()
+                    yield from self._iter_list()
+                elif key == self.list_field:
+                    value = self._value()
+                    if value is not None:
+                        raise ValueError(f"Expected a list or null for {key!r}, "
+                                         f"got {value!r}")
+                elif self.rack is not None:
+                    raise ValueError(f"Field {key!r} comes after {self.list_field!r}, "
+                                     f"the {self.cls.__name__} was already built")
+                else:
+                    self._fields[key] = self._value()
+                if self._next_of(',}') == '}':
+                    break
+        if self._peek():
+            raise ValueError(f"Extra data after the document at offset {self.bytes_read}")
+        if self.rack is None:
+            self._build_rack()
+
+    def _iter_list(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._position += 1
+            return
+        while True:
+            yield self.item_cls(**self._value())
+            if self._next_of(',]') == ']':
+                return
+
+    def _read(self):
+        data = self.fp.read(self.read_size)
+        # A few bytes of a character decode to nothing, only an empty read
+        # is the end of the file
+        if not data:
+            self._eof = True
+        self.bytes_read += len(data)
+        if isinstance(data, bytes):
+            if self._decode is None:
+                self._decode = codecs.getincrementaldecoder('utf-8')().decode
+            data = self._decode(data, final=not data)
+        # Drop what was already parsed so the buffer stays small
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+
+    def _peek(self):
+        while True:
+            buffer = self._buffer
+            position = self._position
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            self._position = position
+            if position < len(buffer):
+                return buffer[position]
+            if self._eof:
+                return ''
+            self._read()
+
+    def _next_of(self, expected):
+        char = self._peek()
+        if not char or char not in expected:
+            raise ValueError(f"Expected one of {expected!r} at offset "
+                             f"{self.bytes_read}, got {char!r}")
+        self._position += 1
+        return char
+
+    def _expect(self, char):
+        self._next_of(char)
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # A number at the very end of the buffer may continue in the
+                # next chunk, so only trust it if something comes after it.
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            self._read()
+
+
+print()
+print("### Example 9 Streaming from_json ###")
+import tempfile
+
+loader = StreamingDatacenterRack.from_json_stream(io.StringIO(serialized), read_size=16)
+for machine in loader:
+    print(f"Machine with {machine.cores} cores, switch already loaded: {loader.rack.switch.ports} ports")
+
+header = json.dumps({"switch": {"ports": 5}, "machines": [{"cores": 1}]})
+loader = StreamingDatacenterRack.from_json_stream(
+    io.StringIO(header + '\n{"cores": 2}\n'), lines=True)
+assert [machine.cores for machine in loader] == [1, 2]
+loader = StreamingDatacenterRack.from_json_stream(
+    io.StringIO('{"machines": null, "switch": {"ports": 5}}'))
+assert list(loader) == [] and loader.rack.machines == []
+loader = StreamingDatacenterRack.from_json_stream(
+    io.BytesIO('{"switch": {"ports": "ééé"}, "machines": []}'.encode()), read_size=1)
+assert list(loader) == [] and loader.rack.switch.ports == "ééé"
+for document in ['{"switch": {}, "machines": [], "extra": 1}', '{"switch": {}, "machines": []} {}']:
+    try:
+        list(StreamingDatacenterRack.from_json_stream(io.StringIO(document)))
+    except ValueError as ex:
+        print("Rejected:", ex)
+    else:
+        assert False, document
+
+rack_data = build_rack_data(100_000 if BENCH else 20_000)
+with tempfile.TemporaryDirectory() as directory:
+    json_path = os.path.join(directory, 'rack.json')
+    lines_path = os.path.join(directory, 'rack.jsonl')
+    with open(json_path, 'w') as fp:
+        StreamingDatacenterRack(**rack_data).to_json_stream(fp)
+    with open(lines_path, 'w') as fp:
+        fp.write(json.dumps({"switch": rack_data["switch"]}) + '\n')
+        for machine in rack_data["machines"]:
+            fp.write(json.dumps(machine) + '\n')
+    expected_ram = sum(machine["ram"] for machine in rack_data["machines"])
+    del rack_data
+
+    with open(json_path) as fp:
+        start = time.perf_counter()
+        rack = DatacenterRack.from_json(fp.read())
+        elapsed = time.perf_counter() - start
+    assert sum(machine.ram for machine in rack.machines) == expected_ram
+    print(f"from_json: {os.path.getsize(json_path) / elapsed / 1e6:.1f} MB/s")
+    del rack
+
+    for label, path, lines in [("JSON", json_path, False), ("JSON Lines", lines_path, True)]:
+        with open(path, 'rb') as fp:
+            loader = StreamingDatacenterRack.from_json_stream(fp, batch_size=1000, lines=lines)
+            total_ram = 0
+            for batch in loader:
+                total_ram += sum(machine.ram for machine in batch)
+        assert total_ram == expected_ram
+        assert loader.rack.switch.ports == 48 and loader.rack.machines == []
+        print(f"from_json_stream ({label}): {loader.mb_per_second:.1f} MB/s")
+
+
+"""
+The rack snapshots are mostly ints and floats, and writing `32e9` as text
+and parsing it back is a big part of the cost of `to_json`/`from_json`.
+
+`BinaryMixin` encodes objects with a schema derived from the constructor of
+their class: the parameter names are written once in the header and every
+object is just its values in that order. A list of objects of the same class
+whose fields are all ints or all floats (`machines`) is written as a table of
+fixed-width `struct` records. `from_bytes` gives back the same kwargs
+`json.loads` would and calls `cls(**kwargs)`, just like `from_json`. Only the
+rows of a table whose schema matches one of `binary_item_classes` are passed
+straight to that class as positional arguments, so `BinaryDatacenterRack`
+gets its `Machine`s without a dict per row.
+
+Layout: MAGIC, the schemas (u16 count, then u16 field count and u16-length
+names) and the root value. Every value starts with a one byte tag. Dict keys
+that aren't strings are written as the strings `json.dumps` would make.
+"""
+import itertools
+import struct
+
+_MAGIC = b'EPB1'
+_NONE, _FALSE, _TRUE, _INT, _BIG_INT, _FLOAT, _STR, _LIST, _DICT, _OBJECT, _TABLE = b'NFTIBDSLMOR'
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_i64 = struct.Struct('<q')
+_f64 = struct.Struct('<d')
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_constructor_fields = {}
+
+
+def _schema_fields(cls):
+    fields = _constructor_fields.get(cls)
+    if fields is None:
+        fields = tuple(inspect.signature(cls).parameters)
+        _constructor_fields[cls] = fields
+    return fields
+
+
+class _BinaryWriter:
+    def __init__(self):
+        self.body = bytearray()
+        self.schemas = {}
+
+    def schema_index(self, fields):
+        index = self.schemas.get(fields)
+        if index is None:
+            if len(self.schemas) > 0xFFFF:
+                raise ValueError("Can't write more than 65536 object schemas")
+            if len(fields) > 0xFFFF:
+                raise ValueError(f"Can't write an object with {len(fields)} fields")
+            index = self.schemas[fields] = len(self.schemas)
+        return index
+
+    def header(self):
+        header = bytearray(_MAGIC)
+        header += _u16.pack(len(self.schemas))
+        for fields in self.schemas:
+            header += _u16.pack(len(fields))
+            for name in fields:
+                encoded = name.encode('utf-8')
+                if len(encoded) > 0xFFFF:
+                    raise ValueError(f"Field name {name[:20]!r}... is too long")
+                header += _u16.pack(len(encoded)) + encoded
+        return bytes(header)
+
+    def object_fields(self, value):
+        # Only objects whose fields are exactly their constructor parameters
+        # can be written with the schema, the rest are written as dicts
+        if not isinstance(value, JsonMixin):
+            return None
+        fields = _schema_fields(type(value))
+        if instance_fields(value).keys() != set(fields):
+            return None
+        return fields
+
+    def write(self, value):
+        body = self.body
+        if value is None:
+            body.append(_NONE)
+        elif value is True:
+            body.append(_TRUE)
+        elif value is False:
+            body.append(_FALSE)
+        elif isinstance(value, int):
+            if _INT64_MIN <= value <= _INT64_MAX:
+                body.append(_INT)
+                body += _i64.pack(value)
+            else:
+                body.append(_BIG_INT)
+                self.write_str(str(value))
+        elif isinstance(value, float):
+            body.append(_FLOAT)
+            body += _f64.pack(value)
+        elif isinstance(value, str):
+            body.append(_STR)
+            self.write_str(value)
+        elif isinstance(value, (list, tuple)):
+            if not self.write_table(value):
+                body.append(_LIST)
+                body += _u32.pack(len(value))
+                for item in value:
+                    self.write(item)
+        elif isinstance(value, dict):
+            body.append(_DICT)
+            body += _u32.pack(len(value))
+            for key, item in value.items():
+                self.write_str(key if type(key) is str else _key_str(key))
+                self.write(item)
+        elif (fields := self.object_fields(value)) is not None:
+            body.append(_OBJECT)
+            body += _u16.pack(self.schema_index(fields))
+            for name in fields:
+                self.write(getattr(value, name))
+        elif has_fields(value):
+            self.write(instance_fields(value))
+        else:
+            raise TypeError(f"Can't encode {type(value).__name__}")
+
+    def write_str(self, value):
+        encoded = value.encode('utf-8')
+        self.body += _u32.pack(len(encoded))
+        self.body += encoded
+
+    def write_table(self, items):
+        if not items:
+            return False
+        item_cls = type(items[0])
+        fields = self.object_fields(items[0])
+        if fields is None:
+            return False
+        codes = []
+        for name in fields:
+            column_types = set(map(type, map(operator.attrgetter(name), items)))
+            if column_types == {float}:
+                codes.append('d')
+            elif column_types == {int}:
+                codes.append('q')
+            else:
+                return False
+        if any(type(item) is not item_cls for item in items):
+            return False
+        record = struct.Struct('<' + ''.join(codes))
+        try:
+            rows = b''.join(map(record.pack, *(
+                map(operator.attrgetter(name), items) for name in fields
+            )))
+        except struct.error:
+            return False  # ints that don't fit in 64 bits
+        body = self.body
+        body.append(_TABLE)
+        body += _u16.pack(self.schema_index(fields))
+        body += _u16.pack(len(codes)) + ''.join(codes).encode('ascii')
+        body += _u32.pack(len(items))
+        body += rows
+        return True
+
+
+class _BinaryReader:
+    def __init__(self, data, item_classes=()):
+        self.data = memoryview(data)
+        self.item_classes = {_schema_fields(cls): cls for cls in item_classes}
+        if bytes(self.data[:4]) != _MAGIC:
+            raise ValueError("Not a binary snapshot")
+        self.offset = 4
+        self.schemas = []
+        for _ in range(self.read(_u16)):
+            fields = []
+            for _ in range(self.read(_u16)):
+                size = self.read(_u16)
+                fields.append(str(self.data[self.offset:self.offset + size], 'utf-8'))
+                self.offset += size
+            self.schemas.append(tuple(fields))
+
+    def read(self, packer):
+        (value,) = packer.unpack_from(self.data, self.offset)
+        self.offset += packer.size
+        return value
+
+    def read_str(self):
+        size = self.read(_u32)
+        value = str(self.data[self.offset:self.offset + size], 'utf-8')
+        self.offset += size
+        return value
+
+    def value(self):
+        tag = self.data[self.offset]
+        self.offset += 1
+        if tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            return self.read(_i64)
+        elif tag == _BIG_INT:
+            return int(self.read_str())
+        elif tag == _FLOAT:
+            return self.read(_f64)
+        elif tag == _STR:
+            return self.read_str()
+        elif tag == _LIST:
+            return [self.value() for _ in range(self.read(_u32))]
+        elif tag == _DICT:
+            return {self.read_str(): self.value() for _ in range(self.read(_u32))}
+        elif tag == _OBJECT:
+            fields = self.schemas[self.read(_u16)]
+            return {name: self.value() for name in fields}
+        elif tag == _TABLE:
+            fields = self.schemas[self.read(_u16)]
+            code_count = self.read(_u16)
+            codes = str(self.data[self.offset:self.offset + code_count], 'ascii')
+            self.offset += code_count
+            record = struct.Struct('<' + codes)
+            count = self.read(_u32)
+            end = self.offset + record.size * count
+            rows = record.iter_unpack(self.data[self.offset:end])
+            self.offset = end
+            item_cls = self.item_classes.get(fields)
+            if item_cls is not None:
+                # The fields are the constructor parameters, in order
+                return list(itertools.starmap(item_cls, rows))
+            return [dict(zip(fields, row)) for row in rows]
+        raise ValueError(f"Unknown tag {tag!r} at offset {self.offset - 1}")
+
+
+class BinaryMixin:
+    __slots__ = ()
+    binary_item_classes = ()
+
+    @classmethod
+    def from_bytes(cls, data):
+        kwargs = _BinaryReader(data, cls.binary_item_classes).value()
+        return cls(**kwargs)
+
+    def to_bytes(self):
+        writer = _BinaryWriter()
+        writer.write(self)
+        return writer.header() + bytes(writer.body)
+
+
+class BinaryDatacenterRack(BinaryMixin, DatacenterRack):
+    binary_item_classes = (Machine,)
+
+    def __init__(self, switch=None, machines=None):
+        super().__init__(switch=switch, machines=[])
+        self.machines = [
+            machine if isinstance(machine, Machine) else Machine(**machine)
+            for machine in machines
+        ]
+
+
+print()
+print("### Example 10 Binary codec ###")
+rack = BinaryDatacenterRack.from_json(serialized)
+data = rack.to_bytes()
+assert BinaryDatacenterRack.from_bytes(data).to_dict() == rack.to_dict()
+print(f"Example rack: {len(data)} bytes, {len(rack.to_json())} as JSON")
+
+value = {1: [2.5, None], 2.5: {}, None: True, False: {'x' * 300: 1}}
+writer = _BinaryWriter()
+writer.write(value)
+data = writer.header() + bytes(writer.body)
+assert _BinaryReader(data).value() == json.loads(json.dumps(value))
+
+machine_count = 1_000_000 if BENCH else 100_000
+rack = BinaryDatacenterRack(**build_rack_data(machine_count))
+start = time.perf_counter()
+json_data = rack.to_json()
+json_encode = time.perf_counter() - start
+start = time.perf_counter()
+binary_data = rack.to_bytes()
+binary_encode = time.perf_counter() - start
+del rack
+json_parse = best_time(lambda: json.loads(json_data), repeat=1)
+binary_parse = best_time(lambda: _BinaryReader(binary_data).value(), repeat=1)
+start = time.perf_counter()
+from_json = BinaryDatacenterRack.from_json(json_data)
+json_decode = time.perf_counter() - start
+del from_json
+start = time.perf_counter()
+from_dict_rows = DatacenterRack(**_BinaryReader(binary_data).value())
+dict_rows_decode = time.perf_counter() - start
+del from_dict_rows
+start = time.perf_counter()
+from_bytes = BinaryDatacenterRack.from_bytes(binary_data)
+binary_decode = time.perf_counter() - start
+assert from_bytes.to_dict() == json.loads(json_data)
+assert type(from_bytes.machines[0]) is Machine
+del from_bytes
+print(f"{machine_count} machines")
+print(f"  to_json   {json_encode:.2f} s, from_json  {json_decode:.2f} s, {len(json_data) / 1e6:.1f} MB")
+print(f"  to_bytes  {binary_encode:.2f} s, from_bytes {binary_decode:.2f} s, {len(binary_data) / 1e6:.1f} MB")
+print(f"  from_bytes with a dict per machine row {dict_rows_decode:.2f} s")
+print(f"  parsing alone (without building the Machines): json.loads "
+      f"{json_parse:.2f} s, binary {binary_parse:.2f} s")
+del json_data, binary_data
+
+
+"""
+Every `Machine` in `DatacenterRack.machines` is an object with its own
+`__dict__`, which costs a couple hundred bytes for three numbers, and
+questions like "how much RAM does this rack have" are Python loops.
+
+`ColumnarDatacenterRack` keeps the machines in `MachineColumns`: one
+`array.array` per field. Indexing it gives a `MachineView`, a small object
+that reads and writes its row in the columns. Totals and filters run over a
+whole column at once. `_traverse` turns the columns back into the list of
+dicts `to_dict` always produced, in the same way `BinaryTreeWithParentFixed`
+customizes it, so `to_dict`/`to_json`/`from_json` keep working. A column
+of ints that fit in 64 bits is an `array('q')` and a column of floats an
+`array('d')`. A column with anything else (a missing field, `None`, ints and
+floats mixed, huge ints) stays a plain list, so every value comes back as it
+went in.
+"""
+import functools
+from array import array
+
+
+class MachineView:
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __repr__(self):
+        return (f"MachineView(cores={self.cores}, ram={self.ram}, "
+                f"disk={self.disk})")
+
+    def _column_property(name):
+        def get(self):
+            return getattr(self._columns, name)[self._index]
+
+        def set(self, value):
+            self._columns._writable(name, value)[self._index] = value
+
+        return property(get, set)
+
+    cores = _column_property('cores')
+    ram = _column_property('ram')
+    disk = _column_property('disk')
+    del _column_property
+
+    def to_dict(self):
+        return {'cores': self.cores, 'ram': self.ram, 'disk': self.disk}
+
+
+def _column(values):
+    # The most compact column that gives back every value unchanged
+    types = set(map(type, values))
+    if types == {int} and -2 ** 63 <= min(values) and max(values) < 2 ** 63:
+        return array('q', values)
+    elif types == {float}:
+        return array('d', values)
+    elif not types:
+        return array('q')
+    else:
+        return list(values)
+
+
+def _fits(column, value):
+    if isinstance(column, list):
+        return True
+    elif column.typecode == 'q':
+        return type(value) is int and -2 ** 63 <= value < 2 ** 63
+    else:
+        return type(value) is float
+
+
+class MachineColumns:
+    fields = ('cores', 'ram', 'disk')
+
+    def __init__(self, machines=()):
+        machines = list(machines)
+        for name in self.fields:
+            setattr(self, name, _column([machine.get(name) for machine in machines]))
+
+    def __len__(self):
+        return len(self.cores)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [MachineView(self, i) for i in range(len(self))[index]]
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} is out of range")
+        return MachineView(self, index)
+
+    def __iter__(self):
+        return map(functools.partial(MachineView, self), range(len(self)))
+
+    def _writable(self, name, value):
+        # The column `value` can be stored in, rebuilt when it doesn't fit
+        column = getattr(self, name)
+        if not _fits(column, value):
+            column = _column([*column, value])
+            column.pop()
+            setattr(self, name, column)
+        return column
+
+    def append(self, cores, ram, disk):
+        self._writable('cores', cores).append(cores)
+        self._writable('ram', ram).append(ram)
+        self._writable('disk', disk).append(disk)
+
+    def total(self, field):
+        return sum(getattr(self, field))
+
+    def indices_where(self, field, compare, value):
+        # e.g. indices_where('disk', operator.gt, 1e12) are the machines with
+        # disk > 1e12, the comparisons run over the column in C
+        matches = map(compare, getattr(self, field), itertools.repeat(value))
+        return list(itertools.compress(range(len(self)), matches))
+
+    def where(self, field, compare, value):
+        indices = self.indices_where(field, compare, value)
+        return [MachineView(self, index) for index in indices]
+
+    def to_list(self):
+        return [
+            {'cores': cores, 'ram': ram, 'disk': disk}
+            for cores, ram, disk in zip(self.cores, self.ram, self.disk)
+        ]
+
+
+class ColumnarDatacenterRack(ToDictMixin, JsonMixin):
+    def __init__(self, switch=None, machines=None):
+        self.switch = Switch(**switch)
+        self.machines = MachineColumns(machines)
+
+    def _traverse(self, key, value):
+        if isinstance(value, MachineColumns):
+            return value.to_list()
+        else:
+            return super()._traverse(key, value)
+
+    def total_ram(self):
+        return self.machines.total('ram')
+
+    def total_cores(self):
+        return self.machines.total('cores')
+
+    def total_disk(self):
+        return self.machines.total('disk')
+
+    def machines_where(self, field, compare, value):
+        return self.machines.where(field, compare, value)
+
+
+print()
+print("### Example 11 Columnar DatacenterRack ###")
+rack = ColumnarDatacenterRack.from_json(serialized)
+print(rack.machines[0], "total RAM", rack.total_ram(), "total cores", rack.total_cores())
+print("Machines with disk > 1e12:", rack.machines_where('disk', operator.gt, 1e12))
+rack.machines[2].cores = 16
+assert json.loads(rack.to_json())["machines"][2]["cores"] == 16
+rack.machines[2].cores = 2
+assert json.loads(serialized) == json.loads(rack.to_json())
+assert [machine.cores for machine in rack.machines[1:]] == [4, 2]
+print("Round trip Passed")
+
+machines = [{"cores": 8, "ram": 2 ** 60 + 1, "disk": 1e12},
+            {"cores": None, "ram": 16, "disk": 2},
+            {"ram": 32}]
+columns = MachineColumns(machines)
+assert columns.to_list() == [{"cores": 8, "ram": 2 ** 60 + 1, "disk": 1e12},
+                             {"cores": None, "ram": 16, "disk": 2},
+                             {"cores": None, "ram": 32, "disk": None}]
+assert type(columns.to_list()[1]["ram"]) is int
+columns = MachineColumns(machines[:1])
+columns.append(8.0, 2 ** 70, 2)
+assert columns.to_list()[1] == {"cores": 8.0, "ram": 2 ** 70, "disk": 2}
+assert type(columns.to_list()[1]["cores"]) is float
+
+rack_data = build_rack_data(100_000)
+for label, build in [("list of Machine", lambda: DatacenterRack(**rack_data)),
+                     ("MachineColumns", lambda: ColumnarDatacenterRack(**rack_data))]:
+    tracemalloc.start()
+    rack = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {size / len(rack_data['machines']):.0f} bytes per machine")
+
+rack = DatacenterRack(**rack_data)
+columnar_rack = ColumnarDatacenterRack(**rack_data)
+assert rack.to_dict() == columnar_rack.to_dict()
+for label, loop, columns in [
+    ("total RAM",
+     lambda: sum(machine.ram for machine in rack.machines),
+     columnar_rack.total_ram),
+    ("disk > 5e12",
+     lambda: [i for i, machine in enumerate(rack.machines) if machine.disk > 5e12],
+     lambda: columnar_rack.machines.indices_where('disk', operator.gt, 5e12)),
+]:
+    print(f"{label}: Python loop {best_time(loop) * 1e3:.2f} ms, "
+          f"columns {best_time(columns) * 1e3:.2f} ms")
+del rack, columnar_rack, rack_data
+
+
+"""
+Even with the streaming loader every job reads and parses the whole
+inventory to look at a handful of machines.
+
+A rack file is a fixed-size header (the switch, the number of machines and
+whether each column holds ints or floats) followed by one fixed-size record
+per machine. `MappedDatacenterRack.open`
+maps the file with `mmap` and only reads the header, so opening is the same
+cost for 10 machines or 10 million. `MappedMachines` unpacks a record from
+the mapping when a machine is asked for, machine N is at a known offset. The
+mapping is read-only, so every process that opens the same file shares the
+pages through the OS page cache.
+"""
+import mmap
+
+_RACK_FILE_MAGIC = b'EPRK'
+# magic, codes for ports, speed, cores, ram, disk, ports, speed, machines
+_rack_file_header = struct.Struct('<4s5s7x8s8sQ')
+
+
+def _column_code(name, values):
+    # Each column is stored as 'q' or 'd' so ints come back as ints
+    types = set(map(type, values))
+    if types <= {int}:
+        return 'q'
+    if types == {float}:
+        return 'd'
+    names = ', '.join(sorted(t.__name__ for t in types))
+    raise ValueError(f"{name} must be all ints or all floats to be saved "
+                     f"in a rack file, got {names}")
+
+
+class MappedMachines:
+    # Records unpacked from a copy at a time by __iter__
+    iter_chunk = 4096
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._records = None
+        try:
+            if len(self._mmap) < _rack_file_header.size:
+                raise ValueError(f"{path} is not a rack file")
+            magic, codes, ports, speed, self._count = (
+                _rack_file_header.unpack_from(self._view, 0)
+            )
+            if magic != _RACK_FILE_MAGIC or codes.strip(b'qd'):
+                raise ValueError(f"{path} is not a rack file")
+            codes = codes.decode()
+            self.ports, = struct.unpack('<' + codes[0], ports)
+            self.speed, = struct.unpack('<' + codes[1], speed)
+            self._record = struct.Struct('<' + codes[2:])
+            end = _rack_file_header.size + self._count * self._record.size
+            if len(self._mmap) < end:
+                raise ValueError(f"{path} is truncated, it should have "
+                                 f"{self._count} machines")
+        except ValueError:
+            self.close()
+            raise
+        self._records = self._view[_rack_file_header.size:end]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(self._count)[index]]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(f"Index {index} is out of range")
+        offset = index * self._record.size
+        return Machine(*self._record.unpack_from(self._records, offset))
+
+    def __iter__(self):
+        # Unpacking a copy of each chunk keeps no view of the mapping alive
+        # between steps, so close() works while an iterator is still around
+        size = self.iter_chunk * self._record.size
+        for start in range(0, self._count * self._record.size, size):
+            if self._records is None:
+                raise ValueError("The rack file is closed")
+            chunk = self._records[start:start + size].tobytes()
+            yield from itertools.starmap(Machine, self._record.iter_unpack(chunk))
+
+    def close(self):
+        # The views have to go before the mapping can be closed
+        if self._mmap is not None:
+            self._records = None
+            self._view.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def to_list(self):
+        return [
+            {'cores': cores, 'ram': ram, 'disk': disk}
+            for cores, ram, disk in self._record.iter_unpack(self._records)
+        ]
+
+
+class MappedDatacenterRack(ToDictMixin, JsonMixin):
+    def __init__(self, switch=None, machines=None):
+        self.switch = switch
+        self.machines = machines
+
+    @classmethod
+    def open(cls, path):
+        machines = MappedMachines(path)
+        switch = Switch(ports=machines.ports, speed=machines.speed)
+        return cls(switch=switch, machines=machines)
+
+    @staticmethod
+    def save(path, rack):
+        # The types are checked before the file is opened
+        switch, machines = rack.switch, rack.machines
+        codes = _column_code('ports', [switch.ports])
+        codes += _column_code('speed', [switch.speed])
+        for name in ['cores', 'ram', 'disk']:
+            codes += _column_code(name, map(operator.attrgetter(name), machines))
+        try:
+            header = _rack_file_header.pack(
+                _RACK_FILE_MAGIC, codes.encode(),
+                struct.pack('<' + codes[0], switch.ports),
+                struct.pack('<' + codes[1], switch.speed),
+                len(machines)
+            )
+            pack = struct.Struct('<' + codes[2:]).pack
+            with open(path, 'wb') as fp:
+                fp.write(header)
+                machines = iter(machines)
+                while chunk := list(itertools.islice(machines, 4096)):
+                    fp.write(b''.join(
+                        pack(machine.cores, machine.ram, machine.disk)
+                        for machine in chunk
+                    ))
+        except struct.error as e:
+            raise ValueError(f"Cannot save the rack: {e}") from e
+
+    def close(self):
+        self.machines.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _traverse(self, key, value):
+        if isinstance(value, MappedMachines):
+            return value.to_list()
+        else:
+            return super()._traverse(key, value)
+
+
+print()
+print("### Example 12 Memory-mapped rack files ###")
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'example.rack')
+    MappedDatacenterRack.save(path, DatacenterRack.from_json(serialized))
+    with MappedDatacenterRack.open(path) as rack:
+        print("Machine 1 is", rack.machines[1].to_dict())
+        assert json.loads(rack.to_json()) == json.loads(serialized)
+        print("Round trip Passed")
+        assert [m.cores for m in rack.machines[1:]] == [4, 2]
+        assert [m.cores for m in rack.machines[::-2]] == [2, 8]
+        machines = iter(rack.machines)
+        next(machines)  # Still unfinished when the rack is closed
+    del machines
+
+    int_rack = DatacenterRack.from_json(
+        '{"switch": {"ports": 5, "speed": 10},'
+        ' "machines": [{"cores": 8, "ram": 32, "disk": 5000}]}'
+    )
+    MappedDatacenterRack.save(path, int_rack)
+    with MappedDatacenterRack.open(path) as rack:
+        assert rack.to_json() == int_rack.to_json()
+    int_rack.machines[0].ram = None
+    try:
+        MappedDatacenterRack.save(path, int_rack)
+    except ValueError as e:
+        print("Bad rack:", e)
+    else:
+        assert False, "Saved a machine without ram"
+    MappedDatacenterRack.save(path, DatacenterRack.from_json(serialized))
+
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    for length in [10, len(data) - 1]:
+        with open(path, 'wb') as fp:
+            fp.write(data[:length])
+        try:
+            MappedDatacenterRack.open(path)
+        except ValueError as e:
+            print("Short file:", e)
+        else:
+            assert False, "Opened a short file"
+
+    for machine_count in [10_000, 1_000_000] if BENCH else [1000, 100_000]:
+        rack_data = build_rack_data(machine_count)
+        path = os.path.join(directory, f'{machine_count}.rack')
+        MappedDatacenterRack.save(path, DatacenterRack(**rack_data))
+        start = time.perf_counter()
+        with MappedDatacenterRack.open(path) as rack:
+            machine = rack.machines[machine_count // 2]
+            elapsed = time.perf_counter() - start
+            assert machine.to_dict() == rack_data["machines"][machine_count // 2]
+        print(f"{machine_count} machines: opened and read machine "
+              f"{machine_count // 2} in {elapsed * 1e6:.0f} us")
+    del rack_data
+
+
+"""
+When only a few leaves change between two snapshots of a big graph,
+`to_dict` still rebuilds every node.
+
+`CachedToDictMixin` keeps the result of `to_dict` and `to_json` on every
+node. Assigning an attribute clears the caches of the node and of every node
+that contains it: each node remembers the nodes it was assigned to (as an
+attribute or inside the lists and dicts of one), so only the path from the change up to
+the root gets encoded again. The next snapshot reuses the cached dicts and
+JSON text of everything else. The bookkeeping lives in `__slots__` so it
+doesn't show up in `__dict__` and isn't serialized.
+
+Lists and dicts changed in place (`rack.machines.append(...)`) can't be
+seen, call `mark_dirty()` on the owner after doing that, it links the owner
+to the new items of its lists and dicts and unlinks the removed ones. The dicts `to_dict` returns
+are shared with the cache and must not be modified.
+"""
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"CacheStats(hits={self.hits}, misses={self.misses})"
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+
+def _cached_children(value):
+    # The nodes to_dict reaches through lists and dicts, not inside other nodes
+    if isinstance(value, CachedToDictMixin):
+        yield value
+    elif isinstance(value, list):
+        for item in value:
+            yield from _cached_children(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _cached_children(item)
+
+
+class CachedToDictMixin(ToDictMixin):
+    __slots__ = ('_cached_dict', '_cached_json', '_parents', '_children')
+    _serialize_slots = False
+    stats = CacheStats()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        self._cached_dict = None
+        self._cached_json = None
+        self._parents = []
+        self._children = None
+        return self
+
+    def __setattr__(self, name, value):
+        if name in CachedToDictMixin.__slots__:
+            super().__setattr__(name, value)
+            return
+        super().__setattr__(name, value)
+        self._link(name, value)
+        self._clear_caches()
+
+    def mark_dirty(self):
+        fields = instance_fields(self)
+        for name in [name for name in self._children or () if name not in fields]:
+            self._link(name, None)
+        for name, value in fields.items():
+            self._link(name, value)
+        self._clear_caches()
+
+    def _link(self, name, value):
+        # The children are remembered per attribute, so the items of a list
+        # changed in place can still be unlinked by mark_dirty
+        linked = self._children.pop(name, ()) if self._children else ()
+        for child in linked:
+            child._parents.remove(self)
+        children = tuple(_cached_children(value))
+        if children:
+            if self._children is None:
+                self._children = {}
+            self._children[name] = children
+            for child in children:
+                child._parents.append(self)
+
+    def _clear_caches(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._cached_dict is None and node._cached_json is None:
+                continue  # Its containers were already marked
+            node._cached_dict = None
+            node._cached_json = None
+            stack.extend(node._parents)
+
+    def to_dict(self):
+        if self._cached_dict is not None:
+            CachedToDictMixin.stats.hits += 1
+            return self._cached_dict
+        CachedToDictMixin.stats.misses += 1
+        self._cached_dict = super().to_dict()
+        return self._cached_dict
+
+    def to_json(self):
+        if self._cached_json is not None:
+            CachedToDictMixin.stats.hits += 1
+            return self._cached_json
+        CachedToDictMixin.stats.misses += 1
+        fields = ', '.join(
+            f"{json.dumps(key)}: {self._json_value(key, value)}"
+            for key, value in instance_fields(self).items()
+        )
+        self._cached_json = '{' + fields + '}'
+        return self._cached_json
+
+    def _json_value(self, key, value):
+        if isinstance(value, list):
+            items = ', '.join(self._json_value(key, item) for item in value)
+            return '[' + items + ']'
+        traversed = self._traverse(key, value)
+        if (isinstance(value, CachedToDictMixin)
+                and traversed is value._cached_dict):
+            # Not customized by _traverse, the child's JSON can be reused
+            return value.to_json()
+        return json.dumps(traversed)
+
+
+class CachedBinaryTree(CachedToDictMixin, BinaryTree):
+    pass
+
+
+class CachedSwitch(CachedToDictMixin, Switch):
+    pass
+
+
+class CachedMachine(CachedToDictMixin, Machine):
+    pass
+
+
+class CachedDatacenterRack(CachedToDictMixin, DatacenterRack):
+    def __init__(self, switch=None, machines=None):
+        self.switch = CachedSwitch(**switch)
+        self.machines = [
+            CachedMachine(**kwargs) for kwargs in machines
+        ]
+
+
+print()
+print("### Example 13 Dirty-tracking to_dict/to_json caches ###")
+depth = 14
+tree = build_complete_tree(BinaryTree, depth)
+cached_tree = build_complete_tree(CachedBinaryTree, depth)
+full = best_time(cached_tree.to_dict, repeat=1)
+assert cached_tree.to_json() == json.dumps(cached_tree.to_dict())
+
+CachedToDictMixin.stats.reset()
+leaf = cached_tree
+tree_leaf = tree
+while leaf.left is not None:
+    leaf, tree_leaf = leaf.left, tree_leaf.left
+leaf.value = tree_leaf.value = -1
+incremental = best_time(cached_tree.to_dict, repeat=1)
+assert cached_tree.to_dict() == tree.to_dict()
+assert cached_tree.to_json() == json.dumps(tree.to_dict())
+print(f"Tree with {2 ** (depth + 1) - 1} nodes: first to_dict {full * 1e3:.1f} ms, "
+      f"after changing a leaf {incremental * 1e3:.3f} ms")
+print("Stats after changing a leaf:", CachedToDictMixin.stats)
+
+rack = CachedDatacenterRack(**build_rack_data(10_000))
+first = rack.to_json()
+CachedToDictMixin.stats.reset()
+for machine in rack.machines[:5]:
+    machine.cores += 1
+start = time.perf_counter()
+snapshot = rack.to_json()
+elapsed = time.perf_counter() - start
+assert json.loads(snapshot) == rack.to_dict() != json.loads(first)
+print(f"Rack with 10000 machines, 5 changed: snapshot in {elapsed * 1e3:.2f} ms,",
+      CachedToDictMixin.stats)
+
+added = CachedMachine(cores=4, ram=16, disk=512)
+removed = rack.machines.pop(0)
+rack.machines.append(added)
+rack.mark_dirty()
+rack.to_json()
+added.cores = 100
+removed.cores = 100
+assert json.loads(rack.to_json()) == rack.to_dict()
+assert rack.to_dict()["machines"][-1]["cores"] == 100
+assert not removed._parents
+
+leaf = CachedBinaryTree(1)
+root = CachedBinaryTree(0, left={'x': leaf})
+root.to_dict()
+leaf.value = 99
+assert root.to_dict()['left']['x']['value'] == 99
+assert json.loads(root.to_json()) == root.to_dict()
+del tree, cached_tree, rack, leaf, root
+
+
+"""
+`to_json` on thousands of racks runs on one core. `BatchJsonMixin.dump_many`
+splits the objects into chunks, serializes the chunks in a process pool and
+writes them as JSON Lines in the original order. `load_many` does the same
+with the lines of a JSON Lines file and `from_json`.
+
+The workers are forked, so `dump_many` doesn't have to pickle the objects to
+send them over: they are left in a module global before the pool starts and
+every worker serializes its own range of it. Only the JSON text comes back.
+`load_many` has to pickle the objects it builds to send them back to us.
+Small batches, a single worker, or platforms without `fork` run inline.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+_objects_to_dump = None
+
+
+def _dump_range(start, stop):
+    return '\n'.join(obj.to_json() for obj in _objects_to_dump[start:stop])
+
+
+def _load_lines(cls, lines):
+    return [cls.from_json(line) for line in lines]
+
+
+def _fork_pool(workers):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+
+
+class BatchJsonMixin(JsonMixin):
+    __slots__ = ()
+
+    # Below this many objects starting the workers costs more than it saves
+    min_parallel_batch = 1000
+
+    @classmethod
+    def dump_many(cls, objs, fp, workers=None, chunk_size=None):
+        global _objects_to_dump
+        objs = list(objs)
+        workers = workers or os.cpu_count()
+        pool = None
+        if workers > 1 and len(objs) >= cls.min_parallel_batch:
+            pool = _fork_pool(workers)
+        if pool is None:
+            for obj in objs:
+                fp.write(obj.to_json() + '\n')
+            return
+
+        chunk_size = chunk_size or -(-len(objs) // (workers * 4))
+        starts = range(0, len(objs), chunk_size)
+        stops = [min(start + chunk_size, len(objs)) for start in starts]
+        _objects_to_dump = objs
+        try:
+            with pool:
+                for text in pool.map(_dump_range, starts, stops):
+                    fp.write(text + '\n')
+        finally:
+            _objects_to_dump = None
+
+    @classmethod
+    def load_many(cls, fp, workers=None, chunk_size=None):
+        lines = [line for line in fp if line.strip()]
+        workers = workers or os.cpu_count()
+        pool = None
+        if workers > 1 and len(lines) >= cls.min_parallel_batch:
+            pool = _fork_pool(workers)
+        if pool is None:
+            return _load_lines(cls, lines)
+
+        chunk_size = chunk_size or -(-len(lines) // (workers * 4))
+        chunks = [lines[start:start + chunk_size]
+                  for start in range(0, len(lines), chunk_size)]
+        objs = []
+        with pool:
+            for loaded in pool.map(_load_lines, itertools.repeat(cls), chunks):
+                objs.extend(loaded)
+        return objs
+
+
+class BatchDatacenterRack(BatchJsonMixin, DatacenterRack):
+    pass
+
+
+print()
+print("### Example 14 Parallel dump_many/load_many ###")
+# Enough racks to reach min_parallel_batch, so the workers are used
+racks = [BatchDatacenterRack(**build_rack_data(20)) for _ in range(5_000 if BENCH else 1_000)]
+expected = ''.join(rack.to_json() + '\n' for rack in racks)
+print(f"{os.cpu_count()} CPUs")
+for workers in sorted({1, 2, os.cpu_count()}):
+    output = io.StringIO()
+    dump = best_time(lambda: BatchDatacenterRack.dump_many(racks, output, workers=workers), repeat=1)
+    assert output.getvalue() == expected
+    output.seek(0)
+    start = time.perf_counter()
+    loaded = BatchDatacenterRack.load_many(output, workers=workers)
+    load = time.perf_counter() - start
+    assert [rack.to_dict() for rack in loaded] == [rack.to_dict() for rack in racks]
+    print(f"{len(racks)} racks with {workers} workers: dump_many {dump:.2f} s, "
+          f"load_many {load:.2f} s")
+del racks, loaded
+
+
+"""
+Every mixin in this file declares `__slots__ = ()` and reads attributes
+through `instance_fields`, so a class can use `__slots__` to drop the
+per-instance `__dict__`, and a subclass that doesn't declare slots (like
+`SlottedBinaryTreeWithParentFixed`) still works with its extra attributes in
+its `__dict__`. Reading the slots costs more than handing over `__dict__`,
+so a slotted `ToDictMixin` saves memory but converts slower, the compiled
+mixin hides most of that. Slotted values that aren't mixins, like
+`Fraction`, are kept whole unless their class sets `_fields_from_slots`.
+"""
+class SlottedBinaryTree(ToDictMixin):
+    __slots__ = ('value', 'left', 'right')
+
+    def __init__(self, value, left=None, right=None):
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+class SlottedBinaryTreeWithParentFixed(SlottedBinaryTree):
+    def __init__(self, value, left=None, right=None, parent=None):
+        super().__init__(value, left=left, right=right)
+        self.parent = parent
+
+    def _traverse(self, key, value):
+        if (isinstance(value, SlottedBinaryTreeWithParentFixed) and key == 'parent'):
+            return value.value  # prevent cycles
+        else:
+            return super()._traverse(key, value)
+
+
+class SlottedCompiledBinaryTree(CompiledToDictMixin):
+    __slots__ = ('value', 'left', 'right')
+
+    def __init__(self, value, left=None, right=None):
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+class SlottedSwitch(ToDictMixin, JsonMixin):
+    __slots__ = ('ports', 'speed')
+
+    def __init__(self, ports=None, speed=None):
+        self.ports = ports
+        self.speed = speed
+
+
+class SlottedMachine(ToDictMixin, JsonMixin):
+    __slots__ = ('cores', 'ram', 'disk')
+
+    def __init__(self, cores=None, ram=None, disk=None):
+        self.cores = cores
+        self.ram = ram
+        self.disk = disk
+
+
+class SlottedDatacenterRack(ToDictMixin, JsonMixin):
+    __slots__ = ('switch', 'machines')
+
+    def __init__(self, switch=None, machines=None):
+        self.switch = SlottedSwitch(**switch)
+        self.machines = [
+            SlottedMachine(**kwargs) for kwargs in machines
+        ]
+
+
+print()
+print("### Example 15 __slots__ ###")
+root = SlottedBinaryTreeWithParentFixed(10)
+root.left = SlottedBinaryTreeWithParentFixed(7, parent=root)
+root.left.right = SlottedBinaryTreeWithParentFixed(9, parent=root.left)
+fixed_root = BinaryTreeWithParentFixed(10)
+fixed_root.left = BinaryTreeWithParentFixed(7, parent=fixed_root)
+fixed_root.left.right = BinaryTreeWithParentFixed(9, parent=fixed_root.left)
+assert root.to_dict() == fixed_root.to_dict()
+assert list(root.to_dict()) == list(fixed_root.to_dict())
+pprint.pprint(root.to_dict())
+
+rack = SlottedDatacenterRack.from_json(serialized)
+assert not hasattr(rack, '__dict__') and not hasattr(rack.machines[0], '__dict__')
+assert json.loads(rack.to_json()) == json.loads(serialized)
+print("Slotted DatacenterRack round trip Passed")
+
+from fractions import Fraction
+assert SlottedBinaryTree(Fraction(1, 3)).to_dict()['value'] == Fraction(1, 3)
+
+depth = 15 if BENCH else 12
+nodes = 2 ** (depth + 1) - 1
+for label, tree_cls in [
+    ("BinaryTree", BinaryTree),
+    ("SlottedBinaryTree", SlottedBinaryTree),
+    ("CompiledBinaryTree", CompiledBinaryTree),
+    ("SlottedCompiledBinaryTree", SlottedCompiledBinaryTree),
+]:
+    tracemalloc.start()
+    tree = build_complete_tree(tree_cls, depth)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    elapsed = best_time(tree.to_dict)
+    print(f"{label}: {size / nodes:.0f} bytes/node, to_dict "
+          f"{elapsed / nodes * 1e9:.0f} ns/node")
+del tree
@@ -18,20 +18,73 @@ print("After pop", repr(foo))
 print("Frequency", foo.frequency())
 
 
+import gc
+import operator
+import os
+
+# The examples time small inputs, set BENCH=1 to time the big ones too
+BENCH = bool(os.environ.get('BENCH'))
+
+
 class BinaryNode:
     def __init__(self, value, left=None, right=None):
         self.value = value
         self.left = left
         self.right = right
 
+    @classmethod
+    def from_sorted(cls, values):
+        # A balanced tree with `values` in order, every node is built after
+        # its children like nested constructors would, with a stack instead
+        # of recursion.
+        values = list(values)
+        if not values:
+            raise ValueError("Can't build a tree without values")
+        # All the new nodes stay alive, the garbage collector would only
+        # walk the growing tree again and again.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            built = []
+            pending = [(0, len(values), False)]
+            while pending:
+                lo, hi, children_built = pending.pop()
+                if lo >= hi:
+                    built.append(None)
+                    continue
+                mid = (lo + hi) // 2
+                if children_built:
+                    right = built.pop()
+                    left = built.pop()
+                    built.append(cls(values[mid], left=left, right=right))
+                else:
+                    pending.append((lo, hi, True))
+                    pending.append((mid + 1, hi, False))
+                    pending.append((lo, mid, False))
+        finally:
+            if enabled:
+                gc.enable()
+        return built[0]
+
 
 class IndexableNode(BinaryNode):
     def _traverse(self):
-        if self.left is not None:
-            yield from self.left._traverse()
-        yield self
-        if self.right is not None:
-            yield from self.right._traverse()
+        # In order with an explicit stack, so deep trees don't hit the
+        # recursion limit and each node is yielded straight to the caller
+        stack = []
+        node = self
+        while True:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            if not stack:
+                return
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def __iter__(self):
+        return map(operator.attrgetter('value'), self._traverse())
 
     def __getitem__(self, index):
         for i, item in enumerate(self._traverse()):
@@ -39,6 +92,19 @@ class IndexableNode(BinaryNode):
                 return item.value
         raise IndexError(f"Index {index} is out of range")
 
+    def index(self, value, start=0, stop=None):
+        if (start is not None and start < 0) or (stop is not None and stop < 0):
+            start, stop, _ = slice(start, stop).indices(sum(1 for _ in self._traverse()))
+        for position, item in enumerate(self):
+            if stop is not None and position >= stop:
+                break
+            if position >= (start or 0) and (item is value or item == value):
+                return position
+        raise ValueError(f"{value!r} is not in the tree")
+
+    def count(self, value):
+        return sum(1 for item in self if item is value or item == value)
+
 
 tree = IndexableNode(
     10,
@@ -135,3 +201,1449 @@ print()
 print('### Example 5 Inheriting from collections and implemented the basic methods ###')
 print('Index of 7 is', tree.index(7))
 print('Count of 10 is', tree.count(10))
+
+
+"""
+`IndexableNode.__getitem__` walks the tree from the first node for every
+index and `SequenceNode.__len__` counts every node, so `tree[i]` in a loop is
+O(n**2) and `len(tree)` is O(n).
+
+`SizedNode` keeps the size of its subtree. `left` and `right` are properties:
+assigning a subtree updates the size of every ancestor, so each node also
+remembers its parent and a node can only be in one place of one tree. With
+the sizes `tree[i]` goes down a single path, O(height), and `len(tree)` is
+O(1).
+
+`tree[a:b:step]` is a lazy iterator: one descent finds position `a` and
+leaves the stack of nodes still to visit, from there it continues in order,
+O(height + k) for k items.
+
+`IndexableNode._traverse` walks the tree with an explicit stack and
+`__iter__` takes the values from it. `index` and `count` scan that iterator
+once instead of using the `Sequence` versions, which call `tree[i]` for every
+position. `SizedNode` runs the same walk on the attributes behind its
+properties, which halves the cost, `index` starts at `start` with one
+descent, and `to_array` writes all the values into a preallocated list (or
+`array.array`) in one pass.
+"""
+import itertools
+from array import array
+
+
+class SizedNode(IndexableNode):
+    def __init__(self, value, left=None, right=None):
+        self._parent = None
+        self._left = None
+        self._right = None
+        self._size = 1
+        super().__init__(value, left=left, right=right)
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def left(self):
+        return self._left
+
+    @left.setter
+    def left(self, node):
+        self._set_child('_left', node)
+
+    @property
+    def right(self):
+        return self._right
+
+    @right.setter
+    def right(self, node):
+        self._set_child('_right', node)
+
+    def _set_child(self, name, node):
+        old = getattr(self, name)
+        if node is old:
+            return
+        if node is not None:
+            if not isinstance(node, SizedNode):
+                raise TypeError(f"Children must be SizedNode, got {type(node).__name__}")
+            if node._parent is not None:
+                raise ValueError(f"Node {node.value!r} already has a parent")
+            ancestor = self
+            while ancestor is not None:
+                if ancestor is node:
+                    raise ValueError(f"Node {node.value!r} can't be its own descendant")
+                ancestor = ancestor._parent
+        if old is not None:
+            old._parent = None
+        if node is not None:
+            node._parent = self
+        setattr(self, name, node)
+        delta = (node._size if node is not None else 0) - (old._size if old is not None else 0)
+        ancestor = self
+        while ancestor is not None:
+            ancestor._size += delta
+            ancestor = ancestor._parent
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._iter_slice(index)
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(f"Index {index} is out of range")
+        node = self
+        while True:
+            left_size = node._left._size if node._left is not None else 0
+            if index < left_size:
+                node = node._left
+            elif index == left_size:
+                return node.value
+            else:
+                index -= left_size + 1
+                node = node._right
+
+    def _traverse(self):
+        # IndexableNode._traverse without going through the properties
+        stack = []
+        node = self
+        while True:
+            while node is not None:
+                stack.append(node)
+                node = node._left
+            if not stack:
+                return
+            node = stack.pop()
+            yield node
+            node = node._right
+
+    def __reversed__(self):
+        return self._iter_from(0, reverse=True)
+
+    def __contains__(self, value):
+        for item in self:
+            if item is value or item == value:
+                return True
+        return False
+
+    def index(self, value, start=0, stop=None):
+        positions = range(*slice(start, stop).indices(self._size))
+        for position, item in zip(positions, self[start:stop]):
+            if item is value or item == value:
+                return position
+        raise ValueError(f"{value!r} is not in the tree")
+
+    def count(self, value):
+        return sum(1 for item in self if item is value or item == value)
+
+    def to_array(self, typecode=None):
+        if typecode is None:
+            values = [None] * self._size
+        else:
+            values = array(typecode, bytes(array(typecode).itemsize * self._size))
+        for position, node in enumerate(self._traverse()):
+            values[position] = node.value
+        return values
+
+    def _iter_from(self, position, reverse=False):
+        # Descend to `position` keeping the nodes that come after it (before
+        # it when going in reverse), then carry on with an in-order walk.
+        near, far = ('_right', '_left') if reverse else ('_left', '_right')
+        stack = []
+        node = self
+        while node is not None:
+            near_size = getattr(node, near)._size if getattr(node, near) is not None else 0
+            if position < near_size:
+                stack.append(node)
+                node = getattr(node, near)
+            elif position == near_size:
+                stack.append(node)
+                break
+            else:
+                position -= near_size + 1
+                node = getattr(node, far)
+        while stack:
+            node = stack.pop()
+            yield node.value
+            node = getattr(node, far)
+            while node is not None:
+                stack.append(node)
+                node = getattr(node, near)
+
+    def _iter_slice(self, index):
+        positions = range(*index.indices(self._size))
+        if not positions:
+            return iter(())
+        step = abs(positions.step)
+        if step > self._size.bit_length():
+            # Long jumps are cheaper as separate descents
+            return (self[position] for position in positions)
+        if positions.step > 0:
+            values = self._iter_from(positions[0])
+        else:
+            values = self._iter_from(self._size - 1 - positions[0], reverse=True)
+        return itertools.islice(values, 0, len(positions) * step, step)
+
+
+class SizedBetterNode(SizedNode, Sequence):
+    pass
+
+
+tree = SizedBetterNode(
+    10,
+    left=SizedBetterNode(
+        5,
+        left=SizedBetterNode(2),
+        right=SizedBetterNode(
+            6,
+            right=SizedBetterNode(7)
+        )
+    ),
+    right=SizedBetterNode(
+        15,
+        left=SizedBetterNode(11)
+    )
+)
+
+print()
+print('### Example 6 Subtree sizes ###')
+print('Length is', len(tree), 'and index 4 is', tree[4])
+tree.left.right.right = None
+print('After removing 7 the length is', len(tree), 'and index 4 is', tree[4])
+tree.right.right = SizedBetterNode(20, left=SizedBetterNode(17))
+print('After adding 17 and 20 the tree is', list(tree), 'with length', len(tree))
+try:
+    tree.left.left = tree.right
+except ValueError as ex:
+    print(f"Error: {ex.args[0]}")
+
+import time
+
+values = list(range(2000))
+for node_cls in (BetterNode, SizedBetterNode):
+    tree = node_cls.from_sorted(values)
+    start = time.perf_counter()
+    assert [tree[i] for i in range(len(tree))] == values
+    elapsed = time.perf_counter() - start
+    print(f"{node_cls.__name__}: tree[i] for all {len(values)} nodes in {elapsed * 1e3:.1f} ms")
+
+
+"""
+Trees are built by hand with nested constructors, nothing keeps them
+balanced, and a tree built from sorted values is a linked list.
+
+`BalancedNode` is an AVL tree: every node also keeps its height, and
+`insert`/`remove` rotate the nodes on the way back up so the two subtrees of
+every node differ in height by one at most. That keeps the height under
+1.44 * log2(n) whatever the order of the input. The tree is the root node
+the caller holds, so a rotation at the root can't replace it: rotations swap
+the values of the two nodes and move the subtrees around them instead, a
+node object may hold a different value after an insert or a remove.
+
+`insert` and `remove` need the tree to be sorted (a binary search tree), the
+trees made by `bulk_load` and `insert` always are. Sorted trees also have
+`irange(lo, hi)`, a lazy iterator over the values `lo <= value < hi`.
+
+Being sorted also means `in`, `index` and `count` don't have to scan the
+tree like the `Sequence` versions do: membership is a descent, `index` is the
+rank of the first equal value and `count` is the difference between the
+ranks of the first and the last equal values, all O(log n). For trees built
+by hand that aren't sorted, set `ordered = False` on the root and they scan.
+"""
+def _height(node):
+    return node._height if node is not None else 0
+
+
+def _size(node):
+    return node._size if node is not None else 0
+
+
+class BalancedNode(SizedBetterNode):
+    ordered = True
+
+    def __init__(self, value, left=None, right=None):
+        self._height = 1
+        super().__init__(value, left=left, right=right)
+
+    @classmethod
+    def bulk_load(cls, values):
+        return cls.from_sorted(sorted(values))
+
+    def _set_child(self, name, node):
+        super()._set_child(name, node)
+        ancestor = self
+        while ancestor is not None:
+            height = 1 + max(_height(ancestor._left), _height(ancestor._right))
+            if height == ancestor._height:
+                break
+            ancestor._height = height
+            ancestor = ancestor._parent
+
+    def _update(self):
+        self._size = 1 + _size(self._left) + _size(self._right)
+        self._height = 1 + max(_height(self._left), _height(self._right))
+
+    def _rotate_right(self):
+        pivot = self._left
+        self.value, pivot.value = pivot.value, self.value
+        outer, inner, right = pivot._left, pivot._right, self._right
+        self._left = outer
+        if outer is not None:
+            outer._parent = self
+        pivot._left = inner
+        pivot._right = right
+        if right is not None:
+            right._parent = pivot
+        self._right = pivot
+        pivot._update()
+        self._update()
+
+    def _rotate_left(self):
+        pivot = self._right
+        self.value, pivot.value = pivot.value, self.value
+        outer, inner, left = pivot._right, pivot._left, self._left
+        self._right = outer
+        if outer is not None:
+            outer._parent = self
+        pivot._right = inner
+        pivot._left = left
+        if left is not None:
+            left._parent = pivot
+        self._left = pivot
+        pivot._update()
+        self._update()
+
+    def _rebalance(self):
+        balance = _height(self._left) - _height(self._right)
+        if balance > 1:
+            if _height(self._left._left) < _height(self._left._right):
+                self._left._rotate_left()
+            self._rotate_right()
+        elif balance < -1:
+            if _height(self._right._right) < _height(self._right._left):
+                self._right._rotate_right()
+            self._rotate_left()
+        else:
+            self._update()
+
+    def _retrace(self, node, size_delta):
+        # Every ancestor of the change has a new size, but heights only need
+        # fixing until a node's height stays the same.
+        ancestor = node
+        while ancestor is not None:
+            ancestor._size += size_delta
+            ancestor = ancestor._parent
+        while node is not None:
+            height = node._height
+            node._rebalance()
+            if node._height == height:
+                break
+            node = node._parent
+
+    def insert(self, value):
+        node = self
+        while True:
+            # Equal values go to the right, after the ones already there
+            side = '_left' if value < node.value else '_right'
+            child = getattr(node, side)
+            if child is None:
+                break
+            node = child
+        child = type(self)(value)
+        child._parent = node
+        setattr(node, side, child)
+        self._retrace(node, 1)
+
+    def _find(self, value):
+        node = self
+        while node is not None:
+            if value < node.value:
+                node = node._left
+            elif node.value < value:
+                node = node._right
+            else:
+                return node
+        raise ValueError(f"{value!r} is not in the tree")
+
+    def _rank(self, value, inclusive=False):
+        # How many values are < value, or <= value when inclusive
+        rank = 0
+        node = self
+        while node is not None:
+            if (not value < node.value) if inclusive else (node.value < value):
+                rank += _size(node._left) + 1
+                node = node._right
+            else:
+                node = node._left
+        return rank
+
+    def __contains__(self, value):
+        if not self.ordered:
+            return super().__contains__(value)
+        try:
+            self._find(value)
+        except ValueError:
+            return False
+        except TypeError:
+            # Not comparable with the values in the tree, but it could
+            # still be equal to one of them.
+            return super().__contains__(value)
+        return True
+
+    def index(self, value, start=0, stop=None):
+        if not self.ordered:
+            return super().index(value, start, stop)
+        if start is not None and start < 0:
+            start = max(len(self) + start, 0)
+        if stop is None:
+            stop = len(self)
+        elif stop < 0:
+            stop += len(self)
+        try:
+            first = self._rank(value)
+            last = self._rank(value, inclusive=True)
+        except TypeError:
+            # Not comparable, scan like __contains__ does
+            return super().index(value, start, stop)
+        position = max(first, start or 0)
+        if position < min(last, stop):
+            return position
+        raise ValueError(f"{value!r} is not in the tree")
+
+    def count(self, value):
+        if not self.ordered:
+            return super().count(value)
+        try:
+            return self._rank(value, inclusive=True) - self._rank(value)
+        except TypeError:
+            return super().count(value)
+
+    def irange(self, lo=None, hi=None):
+        if not self.ordered:
+            return (
+                value for value in self
+                if (lo is None or not value < lo) and (hi is None or value < hi)
+            )
+        start = self._rank(lo) if lo is not None else 0
+        stop = self._rank(hi) if hi is not None else self._size
+        if start >= stop:
+            return iter(())
+        return itertools.islice(self._iter_from(start), stop - start)
+
+    def remove(self, value):
+        node = self._find(value)
+        if node._left is not None and node._right is not None:
+            # Take the value of the next node, which has no left child,
+            # and remove that node instead.
+            successor = node._right
+            while successor._left is not None:
+                successor = successor._left
+            node.value = successor.value
+            node = successor
+
+        child = node._left if node._left is not None else node._right
+        parent = node._parent
+        if parent is None:
+            if child is None:
+                raise ValueError("Can't remove the last value of a tree")
+            # `node` is the root the caller holds, it takes the place of its
+            # only child instead of being unlinked.
+            node.value = child.value
+            node._left, node._right = child._left, child._right
+            for grandchild in (node._left, node._right):
+                if grandchild is not None:
+                    grandchild._parent = node
+            self._retrace(node, -1)
+            return
+        if child is not None:
+            child._parent = parent
+        if parent._left is node:
+            parent._left = child
+        else:
+            parent._right = child
+        node._parent = None
+        self._retrace(parent, -1)
+
+
+print()
+print('### Example 7 Self-balancing tree ###')
+tree = BalancedNode.bulk_load([10, 5, 2, 6, 7, 15, 11])
+for value in [1, 3, 4, 8, 9]:
+    tree.insert(value)
+print('After inserting 1, 3, 4, 8, 9:', list(tree), 'height', tree._height)
+tree.remove(10)
+tree.remove(2)
+print('After removing 10 and 2:', list(tree), 'length', len(tree), 'height', tree._height)
+print('Index of 7 is', tree.index(7), 'and tree[3] is', tree[3])
+
+import math
+import random
+
+for count in [1000, 100_000, 1_000_000] if BENCH else [1000, 10_000]:
+    tree = BalancedNode(0)
+    start = time.perf_counter()
+    for value in range(1, count):
+        tree.insert(value)
+    elapsed = time.perf_counter() - start
+    assert len(tree) == count and tree[count // 2] == count // 2
+    print(f"{count} sorted inserts in {elapsed:.2f} s, height {tree._height} "
+          f"(log2(n) = {math.log2(count):.1f})")
+
+values = list(range(10_000))
+random.shuffle(values)
+tree = BalancedNode.bulk_load(values)
+for value in values[:5000]:
+    tree.remove(value)
+assert list(tree) == sorted(values[5000:])
+print("Removed 5000 random values, height", tree._height)
+
+
+print()
+print('### Example 8 Ordering-aware in, index and count ###')
+tree = BalancedNode.bulk_load([10, 5, 5, 5, 2, 6, 7, 15, 11])
+print('Tree is', list(tree))
+print('Index of 5 is', tree.index(5), 'count of 5 is', tree.count(5), 'and 8 in tree is', 8 in tree)
+print('Index of 5 from position 2 is', tree.index(5, 2))
+# 5+0j equals 5 but can't be ordered against it, these fall back to a scan
+assert 5 + 0j in tree and tree.index(5 + 0j) == 1 and tree.count(5 + 0j) == 3
+
+unordered = BalancedNode(1, left=BalancedNode(9), right=BalancedNode(4))
+unordered.ordered = False
+print('Unordered tree', list(unordered), 'index of 9 is', unordered.index(9),
+      'and 4 in tree is', 4 in unordered)
+
+values = list(range(20_000))
+scanning = SizedBetterNode.from_sorted(values)
+ordered = BalancedNode.bulk_load(values)
+for label, call in [
+    ("index(19999)", lambda tree: tree.index(19999)),
+    ("count(19999)", lambda tree: tree.count(19999)),
+    ("20000 in tree", lambda tree: 20000 in tree),
+]:
+    timings = []
+    for tree in (scanning, ordered):
+        start = time.perf_counter()
+        result = call(tree)
+        timings.append(time.perf_counter() - start)
+    assert call(scanning) == call(ordered)
+    print(f"{label}: scanning {timings[0] * 1e3:.2f} ms, BST descent {timings[1] * 1e3:.3f} ms")
+
+
+print()
+print('### Example 9 Slices and value ranges ###')
+tree = BalancedNode.bulk_load(range(0, 40, 2))
+print('tree[3:8] is', list(tree[3:8]))
+print('tree[::-3] is', list(tree[::-3]))
+print('tree.irange(9, 21) is', list(tree.irange(9, 21)))
+reference = list(tree)
+for index in [slice(None), slice(2, 15, 3), slice(-1, 2, -2), slice(5, 100, 7), slice(10, 3)]:
+    assert list(tree[index]) == reference[index], index
+
+count = 500_000
+tree = BalancedNode.bulk_load(range(count))
+for label, values in [
+    ("islice(iter(tree))", lambda: list(itertools.islice(tree, 400_000, 400_100))),
+    ("tree[i] for each i", lambda: [tree[i] for i in range(400_000, 400_100)]),
+    ("tree[a:b]", lambda: list(tree[400_000:400_100])),
+    ("tree.irange(lo, hi)", lambda: list(tree.irange(400_000, 400_100))),
+]:
+    start = time.perf_counter()
+    assert values() == list(range(400_000, 400_100))
+    print(f"{label}: {(time.perf_counter() - start) * 1e3:.3f} ms")
+
+
+print()
+print('### Example 10 Explicit-stack iteration and to_array ###')
+tree = BalancedNode.bulk_load([10, 5, 2, 6, 7, 15, 11])
+print('Tree is', list(tree), 'reversed', list(reversed(tree)), 'as array', tree.to_array('q'))
+
+unordered = SizedBetterNode(1, left=SizedBetterNode(9), right=SizedBetterNode(4, right=SizedBetterNode(9)))
+print('Index of 9 is', unordered.index(9), 'from position 1 is', unordered.index(9, 1),
+      'count of 9 is', unordered.count(9))
+
+
+def build_chain(node_cls, length):
+    node = node_cls(length - 1)
+    for value in range(length - 2, -1, -1):
+        node = node_cls(value, right=node)
+    return node
+
+
+for label, build in [
+    ("balanced, 100000 nodes", lambda node_cls: node_cls.from_sorted(range(100_000))),
+    ("chain, 5000 nodes", lambda node_cls: build_chain(node_cls, 5000)),
+]:
+    old_tree = build(BetterNode)
+    new_tree = build(SizedBetterNode)
+    expected = list(old_tree)
+    assert expected == list(new_tree) == new_tree.to_array() == list(new_tree.to_array('q'))
+    assert old_tree.index(expected[-1]) == new_tree.index(expected[-1]) == len(expected) - 1
+    assert old_tree.index(expected[-2], -2) == len(expected) - 2
+    assert old_tree.count(expected[0]) == 1
+    for name, call in [
+        ("list(BetterNode)", lambda: list(old_tree)),
+        ("list(SizedBetterNode)", lambda: list(new_tree)),
+        ("SizedBetterNode.to_array()", new_tree.to_array),
+        ("BetterNode.index(last)", lambda: old_tree.index(expected[-1])),
+    ]:
+        start = time.perf_counter()
+        call()
+        print(f"{label}: {name} {(time.perf_counter() - start) * 1e3:.2f} ms")
+
+
+"""
+Trees that are built once and then only read don't need a Python object per
+node. `FrozenTree` keeps the sorted values in one flat list (or
+`array.array`) in Eytzinger order: the root is at slot 1 and the children of
+slot k are at 2k and 2k + 1, like a binary heap, so the tree is complete and
+has no pointers at all.
+
+Searching goes down from slot 1 comparing with the value at each slot, the
+same as a descent through `BalancedNode` but with array reads. Because the
+shape of a complete tree only depends on its length, the in-order position of
+a slot (and the slot of a position) is a few bit operations, so `tree[i]` is
+O(1) and `index`, `count` and `in` are O(log n).
+"""
+def _inorder_slots(size):
+    stack = []
+    slot = 1
+    while True:
+        while slot <= size:
+            stack.append(slot)
+            slot *= 2
+        if not stack:
+            return
+        slot = stack.pop()
+        yield slot
+        slot = 2 * slot + 1
+
+
+class FrozenTree(Sequence):
+    def __init__(self, values, typecode=None):
+        values = list(values)
+        if any(after < before for before, after in zip(values, values[1:])):
+            raise ValueError("Values must be sorted")
+        size = len(values)
+        if typecode is None:
+            layout = [None] * (size + 1)
+        else:
+            layout = array(typecode, bytes(array(typecode).itemsize * (size + 1)))
+        for slot, value in zip(_inorder_slots(size), values):
+            layout[slot] = value
+        self._layout = layout
+        self._size = size
+        # The tree is perfect down to the level above the last one, which
+        # only has its first `_last_level` leaves.
+        self._levels = size.bit_length()
+        self._last_level = size - (1 << self._levels >> 1) + 1 if size else 0
+
+    @classmethod
+    def from_node(cls, node, typecode=None):
+        return cls(node.to_array() if isinstance(node, SizedNode) else node, typecode)
+
+    def to_node(self, node_cls=None):
+        return (node_cls or BalancedNode).from_sorted(self.to_array())
+
+    def to_array(self, typecode=None):
+        if typecode is None:
+            return list(self)
+        return array(typecode, self)
+
+    def _slot(self, position):
+        # Number the positions as if the last level were full, the missing
+        # leaves come after the last one that exists.
+        position += 1
+        if position > 2 * self._last_level:
+            position = 2 * position - 2 * self._last_level
+        return (position + (1 << self._levels)) >> (position & -position).bit_length()
+
+    def _position(self, slot):
+        level = slot.bit_length()
+        position = (2 * (slot - (1 << level >> 1)) + 1) << (self._levels - level)
+        if position > 2 * self._last_level:
+            position = (position + 2 * self._last_level) // 2
+        return position - 1
+
+    def _bound(self, value, inclusive=False):
+        layout = self._layout
+        size = self._size
+        slot = 1
+        if inclusive:
+            while slot <= size:
+                slot = 2 * slot + (not value < layout[slot])
+        else:
+            while slot <= size:
+                slot = 2 * slot + (layout[slot] < value)
+        # Going back up past the right turns at the bottom of the descent
+        # gives the last slot where it turned left, the first value that
+        # wasn't skipped, or 0 when it never turned left.
+        return slot >> (~slot & (slot + 1)).bit_length()
+
+    def _rank(self, value, inclusive=False):
+        slot = self._bound(value, inclusive)
+        return self._position(slot) if slot else self._size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            layout = self._layout
+            return (layout[self._slot(position)]
+                    for position in range(*index.indices(self._size)))
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(f"Index {index} is out of range")
+        return self._layout[self._slot(index)]
+
+    def __iter__(self):
+        return map(self._layout.__getitem__, _inorder_slots(self._size))
+
+    def __contains__(self, value):
+        try:
+            slot = self._bound(value)
+        except TypeError:
+            return any(item is value or item == value for item in self)
+        return slot != 0 and self._layout[slot] == value
+
+    def index(self, value, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self._size)
+        try:
+            first = self._rank(value)
+            last = self._rank(value, inclusive=True)
+        except TypeError:
+            # Not comparable, scan like __contains__ does
+            for position, item in zip(range(start, stop), self[start:stop]):
+                if item is value or item == value:
+                    return position
+            raise ValueError(f"{value!r} is not in the tree") from None
+        position = max(first, start)
+        if position < min(last, stop):
+            return position
+        raise ValueError(f"{value!r} is not in the tree")
+
+    def count(self, value):
+        try:
+            return self._rank(value, inclusive=True) - self._rank(value)
+        except TypeError:
+            return sum(1 for item in self if item is value or item == value)
+
+
+print()
+print('### Example 11 Frozen array-backed tree ###')
+frozen = FrozenTree([2, 5, 5, 6, 7, 10, 11, 15])
+print('Tree is', list(frozen), 'length', len(frozen), 'tree[3] is', frozen[3], 'tree[-1] is', frozen[-1])
+print('Layout is', frozen._layout[1:])
+print('Index of 5 is', frozen.index(5), 'count of 5 is', frozen.count(5), '8 in tree is', 8 in frozen)
+assert frozen.index(5 + 0j) == 1 and frozen.index(5 + 0j, 2) == 2 and frozen.count(5 + 0j) == 2
+print('As a BalancedNode', list(frozen.to_node()), 'and back', list(FrozenTree.from_node(frozen.to_node())))
+try:
+    FrozenTree([3, 1, 2])
+except ValueError as ex:
+    print(f"Error: {ex.args[0]}")
+
+for size in range(40):
+    values = sorted(random.randrange(size // 2 + 1) for _ in range(size))
+    frozen = FrozenTree(values)
+    assert list(frozen) == values and [frozen[i] for i in range(size)] == values
+    for value in range(-1, size // 2 + 2):
+        assert frozen.count(value) == values.count(value)
+        assert (value in frozen) == (value in values)
+        if value in values:
+            assert frozen.index(value) == values.index(value)
+
+import tracemalloc
+
+count = 200_000 if BENCH else 20_000
+values = list(range(0, 2 * count, 2))
+builders = [
+    ("BalancedNode", lambda: BalancedNode.bulk_load(values)),
+    ("FrozenTree (list)", lambda: FrozenTree(values)),
+    ("FrozenTree ('q')", lambda: FrozenTree(values, 'q')),
+]
+probes = [random.randrange(2 * count) for _ in range(20_000)]
+positions = [random.randrange(count) for _ in range(20_000)]
+for label, build in builders:
+    tracemalloc.start()
+    tree = build()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for position in positions:
+        tree[position]
+    getitem = time.perf_counter() - start
+    start = time.perf_counter()
+    for value in probes:
+        value in tree
+    contains = time.perf_counter() - start
+    assert tree.count(probes[0]) == (probes[0] % 2 == 0)
+    print(f"{label}: {memory / count:.0f} bytes per value, "
+          f"tree[i] {getitem / len(positions) * 1e6:.2f} us, "
+          f"in {contains / len(probes) * 1e6:.2f} us")
+
+
+"""
+`FrecuencyList.frequency` counts the whole list on every call, calling it
+after every few appends and pops is quadratic.
+
+`CountingFrecuencyList` keeps a `Counter` in step with the list: every
+method that adds or removes items updates the counts of those items only, so
+`frequency()` is a copy of the counts, O(distinct), and `counts` is a
+read-only view of them that costs nothing. `most_common(k)` picks the k
+largest counts with a heap instead of sorting them all.
+
+The counts are the same as `FrecuencyList.frequency()`, the order of the keys
+isn't always: that one lists the items by their first position in the list,
+this one by when their count was created. They differ once an item is
+inserted before the others or removed completely and added again.
+"""
+import copy
+import pickle
+from collections import Counter
+from types import MappingProxyType
+
+
+class CountingFrecuencyList(FrecuencyList):
+    def __init__(self, members):
+        super().__init__(members)
+        self._counts = Counter(self)
+
+    def _discard(self, items):
+        counts = self._counts
+        for item in items:
+            remaining = counts[item] - 1
+            if remaining:
+                counts[item] = remaining
+            else:
+                del counts[item]
+
+    @property
+    def counts(self):
+        return MappingProxyType(self._counts)
+
+    def frequency(self):
+        return dict(self._counts)
+
+    def most_common(self, k=None):
+        return self._counts.most_common(k)
+
+    def __reduce_ex__(self, protocol):
+        # Rebuilt from its items by __init__, the default for list subclasses
+        # would share or copy the Counter and then append the items again
+        state = {name: value for name, value in vars(self).items() if name != '_counts'}
+        return type(self), (list(self),), state or None
+
+    def append(self, item):
+        super().append(item)
+        self._counts[item] += 1
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        self._counts.update(items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, times):
+        super().__imul__(times)
+        if times <= 0:
+            self._counts.clear()
+        else:
+            for item in self._counts:
+                self._counts[item] *= times
+        return self
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._counts[item] += 1
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._discard((item,))
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self._discard((item,))
+
+    def clear(self):
+        super().clear()
+        self._counts.clear()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            replaced = self[index]
+            super().__setitem__(index, value)
+            self._discard(replaced)
+            self._counts.update(value)
+        else:
+            replaced = self[index]
+            super().__setitem__(index, value)
+            self._discard((replaced,))
+            self._counts[value] += 1
+
+    def __delitem__(self, index):
+        removed = self[index]
+        super().__delitem__(index)
+        self._discard(removed if isinstance(index, slice) else (removed,))
+
+
+print()
+print('### Example 12 Incrementally maintained counts ###')
+foo = CountingFrecuencyList(['a', 'b', 'a', 'c', 'b', 'a', 'd'])
+foo.pop()
+foo[1:3] = ['c', 'c', 'c']
+del foo[0]
+print("After pop, slice assignment and del", repr(foo))
+print("Frequency", foo.frequency(), "most common", foo.most_common(2))
+
+operations = [
+    lambda items: items.append(random.randrange(20)),
+    lambda items: items.extend(random.randrange(20) for _ in range(3)),
+    lambda items: items.insert(random.randrange(-5, 5), random.randrange(20)),
+    lambda items: items.pop(random.randrange(len(items))) if items else None,
+    lambda items: items.remove(items[0]) if items else None,
+    lambda items: items.__setitem__(random.randrange(len(items)), 'x') if items else None,
+    lambda items: items.__setitem__(slice(2, 6), ['y'] * random.randrange(6)),
+    lambda items: items.__setitem__(slice(None, None, 3), ['z'] * len(items[::3])),
+    lambda items: items.__delitem__(slice(1, None, 4)),
+    lambda items: items.__iadd__(['w', 'w']),
+    lambda items: items.__imul__(random.randrange(3)) if len(items) < 50 else None,
+]
+foo = CountingFrecuencyList(range(10))
+for _ in range(5000):
+    random.choice(operations)(foo)
+    assert foo.frequency() == FrecuencyList(foo).frequency()  # Same counts, maybe not the same order
+assert [count for _, count in foo.most_common(3)] == [count for _, count in Counter(foo).most_common(3)]
+print("Counts match a full recount after 5000 random operations")
+
+foo = CountingFrecuencyList('aab')
+for duplicate in (copy.copy(foo), copy.deepcopy(foo), pickle.loads(pickle.dumps(foo))):
+    duplicate.pop()
+    assert duplicate.frequency() == {'a': 2} and foo.frequency() == {'a': 2, 'b': 1}
+
+for frequency_cls in (FrecuencyList, CountingFrecuencyList):
+    foo = frequency_cls(random.randrange(1000) for _ in range(100_000))
+    start = time.perf_counter()
+    for batch in range(200):
+        foo.extend(range(batch, batch + 100))
+        for _ in range(10):
+            foo.pop()
+        foo.frequency()
+    elapsed = time.perf_counter() - start
+    print(f"{frequency_cls.__name__}: 200 batches with frequency() after each in {elapsed * 1e3:.0f} ms")
+
+
+"""
+Streams too big to keep in a list only need the frequent items, approximately.
+`FrecuencySketch` reads any iterator and keeps two fixed-size summaries:
+
+* A Count-Min sketch, `depth` rows of `width` counters. Every item adds to one
+  counter per row and its estimate is the smallest of them, which is never
+  below the real count and, with probability 1 - delta, at most
+  epsilon * total above it (width = e / epsilon, depth = ln(1 / delta)).
+* A Space-Saving table with room for `capacity` items. An item that isn't in
+  a full table replaces the one with the smallest count and takes over that
+  count. The counts are over by epsilon * total at most and every item seen
+  more often than that is in the table, so it answers `most_common`.
+
+The items are read in chunks that are counted with a `Counter` first, so an
+item repeated in a chunk is hashed once. Memory depends on epsilon, delta and
+the chunk size, not on the length of the stream. The hashes come from
+`blake2b` on the bytes `key_bytes(item)` gives, `repr(item)` encoded by
+default. Equal items have to give the same bytes, in every process for
+sketches filled by different workers to be merged: the default is right for
+str, bytes, int and tuples of them, but `1` and `1.0` land in different
+counters and objects with the default `repr` (it has their address) never
+match across processes. Pass a `key_bytes` for items like those.
+"""
+import hashlib
+import heapq
+
+
+def _repr_bytes(item):
+    return repr(item).encode()
+
+
+class FrecuencySketch:
+    def __init__(self, epsilon=0.001, delta=0.01, top=100, seed=0, key_bytes=_repr_bytes):
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise ValueError("epsilon and delta must be between 0 and 1")
+        self.epsilon = epsilon
+        self.delta = delta
+        self.seed = seed
+        self.key_bytes = key_bytes
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.capacity = max(top, math.ceil(1 / epsilon))
+        self.total = 0
+        self._table = array('q', bytes(8 * self.width * self.depth))
+        self._key = seed.to_bytes(8, 'little')
+        self._counters = {}  # item -> [count, error]
+        self._heap = []  # (count, tiebreaker, item), some of them stale
+        self._tiebreaker = itertools.count()
+
+    def _slots(self, item):
+        digest = hashlib.blake2b(self.key_bytes(item), digest_size=16, key=self._key).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        width = self.width
+        return [row * width + (first + row * second) % width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        table = self._table
+        for slot in self._slots(item):
+            table[slot] += count
+        self.total += count
+
+        counters = self._counters
+        heap = self._heap
+        entry = counters.get(item)
+        if entry is not None:
+            entry[0] += count
+            heapq.heappush(heap, (entry[0], next(self._tiebreaker), item))
+        elif len(counters) < self.capacity:
+            counters[item] = [count, 0]
+            heapq.heappush(heap, (count, next(self._tiebreaker), item))
+        else:
+            while True:
+                smallest, _, victim = heap[0]
+                entry = counters.get(victim)
+                if entry is not None and entry[0] == smallest:
+                    break
+                heapq.heappop(heap)
+            del counters[victim]
+            counters[item] = [smallest + count, smallest]
+            heapq.heapreplace(heap, (smallest + count, next(self._tiebreaker), item))
+        if len(heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [
+            (count, next(self._tiebreaker), item)
+            for item, (count, _) in self._counters.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def update(self, items, chunk_size=65_536):
+        items = iter(items)
+        while True:
+            chunk = Counter(itertools.islice(items, chunk_size))
+            if not chunk:
+                return self
+            for item, count in chunk.items():
+                self.add(item, count)
+
+    def estimate(self, item):
+        table = self._table
+        estimate = min(table[slot] for slot in self._slots(item))
+        entry = self._counters.get(item)
+        return min(estimate, entry[0]) if entry is not None else estimate
+
+    def most_common(self, k=None):
+        counters = sorted(self._counters.items(), key=lambda pair: pair[1][0], reverse=True)
+        return [(item, count) for item, (count, _) in counters[:k]]
+
+    def heavy_hitters(self, fraction):
+        threshold = fraction * self.total
+        return [(item, count) for item, count in self.most_common() if count > threshold]
+
+    def merge(self, other):
+        settings = ('epsilon', 'delta', 'seed', 'capacity', 'key_bytes')
+        if any(getattr(self, name) != getattr(other, name) for name in settings):
+            raise ValueError("Can only merge sketches with the same settings")
+        table = self._table
+        for slot, count in enumerate(other._table):
+            if count:
+                table[slot] += count
+        self.total += other.total
+
+        # An item missing from a full table may have been seen as many times
+        # as the smallest count in it, and no more.
+        floors = []
+        for counters in (self._counters, other._counters):
+            full = len(counters) >= self.capacity
+            floors.append(min(count for count, _ in counters.values()) if full else 0)
+        merged = {}
+        for item in self._counters.keys() | other._counters.keys():
+            count, error = 0, 0
+            for counters, floor in zip((self._counters, other._counters), floors):
+                entry = counters.get(item, (floor, floor))
+                count += entry[0]
+                error += entry[1]
+            merged[item] = [count, error]
+        largest = heapq.nlargest(self.capacity, merged.items(), key=lambda pair: pair[1][0])
+        self._counters = dict(largest)
+        self._rebuild_heap()
+        return self
+
+
+print()
+print('### Example 13 Streaming frequency sketch ###')
+sketch = FrecuencySketch(epsilon=0.01, top=3).update(['a', 'b', 'a', 'c', 'b', 'a', 'd'])
+print('Most common', sketch.most_common(3), 'estimate of a', sketch.estimate('a'),
+      'of z', sketch.estimate('z'), 'sketch size', sketch.width, 'x', sketch.depth)
+sketch = FrecuencySketch(epsilon=0.01, key_bytes=lambda number: float(number).hex().encode())
+sketch.update([1, 1.0, 2, 1])
+assert sketch.estimate(1.0) == sketch.estimate(1) == 3
+
+pages = [f"/page/{rank}" for rank in range(100_000)]
+weights = list(itertools.accumulate(1 / rank for rank in range(1, len(pages) + 1)))
+
+
+def clickstream(count, seed):
+    generator = random.Random(seed)
+    for _ in range(count // 10_000):
+        yield from generator.choices(pages, cum_weights=weights, k=10_000)
+
+
+for events in [100_000, 400_000] if BENCH else [20_000, 80_000]:
+    tracemalloc.start()
+    FrecuencySketch(epsilon=0.0005, delta=0.001, top=20).update(clickstream(events, seed=1), chunk_size=8192)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{events} clicks: peak memory {peak / 2**20:.1f} MiB")
+
+events = 1_000_000 if BENCH else 200_000
+sketch = FrecuencySketch(epsilon=0.0005, delta=0.001, top=20)
+start = time.perf_counter()
+sketch.update(clickstream(events, seed=1))
+elapsed = time.perf_counter() - start
+exact = Counter(clickstream(events, seed=1))
+errors = [sketch.estimate(page) - count for page, count in exact.items()]
+assert min(errors) >= 0
+within = sum(error <= sketch.epsilon * events for error in errors) / len(errors)
+print(f"{events} clicks in {elapsed:.2f} s, {within:.2%} of the estimates within "
+      f"epsilon * total = {sketch.epsilon * events:.0f} (expected at least {1 - sketch.delta:.1%})")
+print("Top 5", sketch.most_common(5))
+assert [page for page, _ in sketch.most_common(10)] == [page for page, _ in exact.most_common(10)]
+
+shards = [FrecuencySketch(epsilon=0.0005, delta=0.001, top=20).update(clickstream(events // 4, seed))
+          for seed in range(2, 6)]
+merged = shards[0]
+for shard in shards[1:]:
+    merged.merge(shard)
+exact = Counter(itertools.chain.from_iterable(clickstream(events // 4, seed) for seed in range(2, 6)))
+assert merged.total == events
+assert [page for page, _ in merged.most_common(10)] == [page for page, _ in exact.most_common(10)]
+assert all(merged.estimate(page) >= count for page, count in exact.most_common(1000))
+print("Merged 4 shards, top 5", merged.most_common(5))
+
+
+"""
+`FrecuencyList.frequency` is one Python loop over the whole list.
+`ParallelFrecuencyList.frequency(workers=N)` cuts the list in chunks, counts
+them with `Counter` in a pool of forked workers, and adds the partial counts
+up in chunk order, so the result is the same dict as the serial one, even the
+order of the keys.
+
+Lists of plain ints that fit in 64 bits, or of floats that aren't NaN, are
+copied once into a shared memory block that every worker reads its chunk
+from. Anything else is sent to the workers in pickled chunks. The objects
+that come back from those are copies, so the workers return the position of
+the first occurrence of every item in their chunk and the keys of the result
+are taken from our list. Short lists, a single worker, or platforms without
+`fork` count serially.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+def _fork_pool(workers):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+
+
+def _numeric_typecode(items):
+    if all(type(item) is int for item in items):
+        return 'q'
+    if all(type(item) is float and item == item for item in items):
+        return 'd'
+    return None
+
+
+def _count_shared(name, typecode, start, stop):
+    memory = shared_memory.SharedMemory(name)
+    try:
+        values = memory.buf.cast(typecode)
+        chunk = values[start:stop]
+        try:
+            return list(Counter(chunk).items())
+        finally:
+            chunk.release()
+            values.release()
+    finally:
+        memory.close()
+
+
+def _count_chunk(items):
+    first = dict(zip(reversed(items), range(len(items) - 1, -1, -1)))
+    return [(first[item], count) for item, count in Counter(items).items()]
+
+
+class ParallelFrecuencyList(FrecuencyList):
+    # Below this many items starting the workers costs more than it saves
+    min_parallel_size = 500_000
+
+    def frequency(self, workers=None, chunk_size=None):
+        pool = None
+        if workers is not None and workers > 1 and len(self) >= self.min_parallel_size:
+            pool = _fork_pool(workers)
+        if pool is None:
+            return super().frequency()
+
+        chunk_size = chunk_size or -(-len(self) // workers)
+        starts = range(0, len(self), chunk_size)
+        stops = [min(start + chunk_size, len(self)) for start in starts]
+        counts = {}
+        typecode = _numeric_typecode(self)
+        if typecode is not None:
+            try:
+                values = array(typecode, self)
+            except OverflowError:
+                typecode = None
+        with pool:
+            if typecode is None:
+                chunks = (self[start:stop] for start, stop in zip(starts, stops))
+                for start, partial in zip(starts, pool.map(_count_chunk, chunks)):
+                    for offset, count in partial:
+                        item = self[start + offset]
+                        counts[item] = counts.get(item, 0) + count
+                return counts
+
+            memory = shared_memory.SharedMemory(create=True, size=max(len(values) * values.itemsize, 1))
+            try:
+                memory.buf[:len(values) * values.itemsize] = values.tobytes()
+                del values
+                partials = pool.map(_count_shared, itertools.repeat(memory.name),
+                                    itertools.repeat(typecode), starts, stops)
+                for partial in partials:
+                    for item, count in partial:
+                        counts[item] = counts.get(item, 0) + count
+            finally:
+                memory.close()
+                memory.unlink()
+        return counts
+
+
+print()
+print('### Example 14 Parallel frequency ###')
+nan = float('nan')
+for items in [
+    [random.randrange(1000) for _ in range(50_000)],
+    [random.randrange(1000) / 8 for _ in range(50_000)],
+    [random.choice(['a', 'b', 'c', 2**70, 1.5, nan, None, (1, 2)]) for _ in range(50_000)],
+    [object() for _ in range(10)] * 5000,
+]:
+    foo = ParallelFrecuencyList(items)
+    foo.min_parallel_size = 0
+    serial = foo.frequency()
+    parallel = foo.frequency(workers=4, chunk_size=7000)
+    assert parallel == serial and list(parallel) == list(serial)
+    if _numeric_typecode(items) is None:
+        assert all(a is b for a, b in zip(parallel, serial))
+print("Parallel counts match the serial ones for ints, floats, mixed objects and identity-equal objects")
+
+print(f"{os.cpu_count()} CPUs")
+crossover = None
+for size in [100_000, 1_000_000, 4_000_000] if BENCH else [100_000, 500_000]:
+    for label, population in [("ints", range(10_000)), ("strings", pages[:10_000])]:
+        foo = ParallelFrecuencyList(random.choices(population, k=size))
+        foo.min_parallel_size = 0
+        start = time.perf_counter()
+        foo.frequency()
+        serial = time.perf_counter() - start
+        start = time.perf_counter()
+        foo.frequency(workers=4)
+        parallel = time.perf_counter() - start
+        if crossover is None and parallel < serial:
+            crossover = size
+        print(f"{size} {label}: serial {serial * 1e3:.0f} ms, 4 workers {parallel * 1e3:.0f} ms")
+print(f"Parallel counting wins from {crossover} items" if crossover else "Parallel counting doesn't win on this machine")
+
+
+"""
+`BinaryNode.from_sorted(values)` builds a balanced tree from values that are
+already in order in O(n), with a stack instead of recursion, so there's no
+depth limit. `bulk_load` and `FrozenTree.to_node` use it.
+
+`dump_snapshot`/`load_snapshot` save a tree in a compact binary format
+instead of JSON: a header, then two bits per node in preorder saying whether
+it has a left and a right child, then the values in preorder. Values that
+are all 64 bit ints or all floats are written as a raw `array`, anything else
+as one list with `marshal`, which only holds plain data (None, bools, numbers,
+strings, bytes and lists, tuples, dicts and sets of them) and raises a
+`ValueError` for other objects. Unlike `pickle`, loading a snapshot from
+someone else can't run code. Loading goes through the nodes in reverse preorder,
+where both children of a node are built before it, so every node is built
+with its constructor like `from_sorted` does and the sizes and heights of the
+node classes above stay right. Both pause the garbage collector while they
+build, it would otherwise go through all the nodes built so far many times.
+"""
+import io
+import json
+import marshal
+import struct
+import tempfile
+
+_SNAPSHOT_HEADER = struct.Struct('<4scQ')  # magic, value typecode, node count
+_SNAPSHOT_MAGIC = b'BNSS'
+_SHAPE_BITS = ('00', '01', '10', '11')
+
+
+def dump_snapshot(tree, fp):
+    values = []
+    shape = []
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        values.append(node.value)
+        left, right = node.left, node.right
+        shape.append(_SHAPE_BITS[(left is not None) << 1 | (right is not None)])
+        if right is not None:
+            pending.append(right)
+        if left is not None:
+            pending.append(left)
+
+    typecode = _numeric_typecode(values)
+    if typecode is not None:
+        try:
+            values = array(typecode, values)
+        except OverflowError:
+            typecode = None
+    if typecode is None:
+        try:
+            values = marshal.dumps(values)
+        except ValueError:
+            raise ValueError("Snapshots can only hold None, bools, numbers, strings, bytes "
+                             "and lists, tuples, dicts and sets of them") from None
+    fp.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, (typecode or 'm').encode(), len(shape)))
+    # The leading 1 keeps the zeros at the start of the bits.
+    bits = int('1' + ''.join(shape), 2)
+    fp.write(bits.to_bytes((bits.bit_length() + 7) // 8, 'big'))
+    if typecode is None:
+        fp.write(values)
+    else:
+        values.tofile(fp)
+
+
+def load_snapshot(node_cls, fp):
+    magic, typecode, count = _SNAPSHOT_HEADER.unpack(fp.read(_SNAPSHOT_HEADER.size))
+    if magic != _SNAPSHOT_MAGIC:
+        raise ValueError("Not a tree snapshot")
+    shape = bin(int.from_bytes(fp.read((2 * count + 8) // 8), 'big'))[3:]
+    if typecode == b'm':
+        values = marshal.load(fp)
+        if type(values) is not list or len(values) != count:
+            raise ValueError("Not a tree snapshot")
+    else:
+        values = array(typecode.decode())
+        values.fromfile(fp, count)
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        built = []
+        for position in range(count - 1, -1, -1):
+            left = built.pop() if shape[2 * position] == '1' else None
+            right = built.pop() if shape[2 * position + 1] == '1' else None
+            built.append(node_cls(values[position], left=left, right=right))
+    finally:
+        if enabled:
+            gc.enable()
+    return built[0]
+
+
+print()
+print('### Example 15 Linear bulk construction and binary snapshots ###')
+tree = BetterNode.from_sorted([2, 5, 6, 7, 10, 11, 15])
+print('Tree is', list(tree), 'root', tree.value, 'left', tree.left.value, 'right', tree.right.value)
+chain = build_chain(SizedBetterNode, 20)
+buffer = io.BytesIO()
+dump_snapshot(chain, buffer)
+print(f"A 20 node chain takes {len(buffer.getvalue())} bytes")
+buffer.seek(0)
+copy = load_snapshot(SizedBetterNode, buffer)
+assert list(copy) == list(chain) and copy.right.right.left is None and len(copy.right) == 19
+
+for values in [list(range(100)), [value / 3 for value in range(50)], ['a', None, 2**80, (1, 2)]]:
+    for node_cls in (BetterNode, SizedBetterNode, BalancedNode):
+        tree = node_cls.from_sorted(values)
+        buffer = io.BytesIO()
+        dump_snapshot(tree, buffer)
+        buffer.seek(0)
+        copy = load_snapshot(node_cls, buffer)
+        assert list(copy) == list(tree)
+        assert [node.value for node in copy._traverse()] == [node.value for node in tree._traverse()]
+print("Snapshots restore the same trees for ints, floats and other objects")
+try:
+    dump_snapshot(BetterNode(object()), io.BytesIO())
+except ValueError as ex:
+    print("Error:", ex)
+else:
+    assert False, "Dumped an object marshal can't hold"
+
+count = 1_000_000 if BENCH else 100_000
+start = time.perf_counter()
+tree = SizedBetterNode.from_sorted(range(count))
+print(f"SizedBetterNode.from_sorted {count} values in {time.perf_counter() - start:.2f} s, "
+      f"tree[12345] is {tree[12345]}")
+del tree
+
+
+def _to_plain(node):
+    return {
+        'value': node.value,
+        'left': _to_plain(node.left) if node.left is not None else None,
+        'right': _to_plain(node.right) if node.right is not None else None,
+    }
+
+
+def _from_plain(node_cls, data):
+    left, right = data['left'], data['right']
+    return node_cls(
+        data['value'],
+        left=_from_plain(node_cls, left) if left is not None else None,
+        right=_from_plain(node_cls, right) if right is not None else None,
+    )
+
+
+for count in [1_000_000, 10_000_000] if BENCH else [100_000]:
+    tree = BinaryNode.from_sorted(range(count))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.snapshot')
+        start = time.perf_counter()
+        with open(path, 'wb') as fp:
+            dump_snapshot(tree, fp)
+        dumped = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path, 'rb') as fp:
+            copy = load_snapshot(BinaryNode, fp)
+        loaded = time.perf_counter() - start
+        print(f"{count} nodes snapshot: {os.path.getsize(path) / 2**20:.1f} MiB, "
+              f"dump {dumped:.2f} s, load {loaded:.2f} s")
+        assert copy.value == tree.value and copy.left.right.value == tree.left.right.value
+        del copy
+        if count > 1_000_000:
+            continue  # The JSON text and its dicts take too much memory
+
+        path = os.path.join(directory, 'tree.json')
+        start = time.perf_counter()
+        with open(path, 'w') as fp:
+            fp.write(json.dumps(_to_plain(tree)))
+        dumped = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path) as fp:
+            copy = _from_plain(BinaryNode, json.loads(fp.read()))
+        loaded = time.perf_counter() - start
+        print(f"{count} nodes JSON: {os.path.getsize(path) / 2**20:.1f} MiB, "
+              f"dump {dumped:.2f} s, load {loaded:.2f} s")
+        del copy
+    del tree
@@ -1,5 +1,9 @@
+import os
 from datetime import datetime, timedelta
 
+# The examples time small inputs, set BENCH=1 to time the big ones too
+BENCH = bool(os.environ.get('BENCH'))
+
 
 class Bucket:
     def __init__(self, period):
@@ -85,3 +89,791 @@ takeout(bucket, 99)
 print("Now", bucket)
 takeout(bucket, 3)
 print("Still", bucket)
+
+
+"""
+`Bucket` and `NewBucket` ask for `datetime.now()` and do `timedelta` math on
+every call, a few new objects each time, the period breaks if the wall clock
+is changed, and the whole quota comes back at once when a period ends.
+
+`TokenBucket` refills continuously instead: it holds up to `burst` tokens and
+gains `rate` tokens per second, worked out lazily from `time.monotonic_ns()`
+when it is used, which never goes back. It only keeps numbers in its slots.
+`fill` and `deduct` are wrapped to hand the call over to buckets that have
+their own `fill`/`deduct` methods, so `takeout` works with it unchanged, and
+the originals stay as they were for `Bucket` and `NewBucket`. Both methods
+also take `now` in nanoseconds, to decide for a given time.
+"""
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate_per_ns', 'burst', 'tokens', 'updated_ns')
+
+    def __init__(self, rate, burst, tokens=0):
+        self.rate_per_ns = rate / 1e9
+        self.burst = burst
+        self.tokens = min(tokens, burst)
+        self.updated_ns = time.monotonic_ns()
+
+    @classmethod
+    def per_period(cls, period, quota):
+        # Up to `quota` at once, and `quota` more every `period` seconds
+        return cls(quota / period, quota)
+
+    def __repr__(self):
+        return f'TokenBucket(quota={self.quota:.2f})'
+
+    def _refill(self, now):
+        elapsed = now - self.updated_ns
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate_per_ns)
+            self.updated_ns = now
+
+    @property
+    def quota(self):
+        self._refill(time.monotonic_ns())
+        return self.tokens
+
+    def fill(self, amount, now=None):
+        self._refill(time.monotonic_ns() if now is None else now)
+        self.tokens = min(self.burst, self.tokens + amount)
+
+    def deduct(self, amount, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        tokens = self.tokens
+        elapsed = now - self.updated_ns
+        if elapsed > 0:
+            tokens += elapsed * self.rate_per_ns
+            if tokens > self.burst:
+                tokens = self.burst
+            self.updated_ns = now
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+
+period_fill = fill
+period_deduct = deduct
+
+
+def fill(bucket, amount):
+    if hasattr(bucket, 'fill'):
+        return bucket.fill(amount)  # It keeps its own time
+    return period_fill(bucket, amount)
+
+
+def deduct(bucket, amount):
+    if hasattr(bucket, 'deduct'):
+        return bucket.deduct(amount)
+    return period_deduct(bucket, amount)
+
+
+print()
+print("Third Bucket <TokenBucket>: 100 per 60 seconds")
+bucket = TokenBucket.per_period(60, 100)
+fill(bucket, 100)
+print(bucket)
+print("First Takeout 99")
+takeout(bucket, 99)
+print("Second Takeout 3")
+takeout(bucket, 3)
+
+SECOND = 1_000_000_000
+bucket = TokenBucket(rate=10, burst=5, tokens=5)
+start = bucket.updated_ns
+print("10 per second with bursts of 5:",
+      [bucket.deduct(1, now=start) for _ in range(6)],
+      "300 ms later:", [bucket.deduct(1, now=start + 3 * SECOND // 10) for _ in range(4)])
+
+decisions = 100_000
+
+
+def best_ns_per_call(call, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(decisions):
+            call()
+        elapsed = (time.perf_counter_ns() - start) / decisions
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+for label, make in [("Bucket", lambda: Bucket(60)), ("NewBucket", lambda: NewBucket(60))]:
+    bucket = make()
+    period_fill(bucket, 10 * decisions)
+    print(f"{label}: {best_ns_per_call(lambda: period_deduct(bucket, 1)):.0f} ns per deduct(bucket, 1)")
+bucket = TokenBucket.per_period(60, 10 * decisions)
+fill(bucket, 10 * decisions)
+print(f"TokenBucket: {best_ns_per_call(lambda: deduct(bucket, 1)):.0f} ns per deduct(bucket, 1)")
+print(f"TokenBucket: {best_ns_per_call(lambda: bucket.deduct(1)):.0f} ns per bucket.deduct(1)")
+
+
+"""
+A bucket object per client costs a lot of memory with millions of clients.
+`GcraLimiter` (generic cell rate algorithm) makes the same decisions as a
+`TokenBucket` that starts full with one float per key: the time at which the
+bucket of that key would be full again (its theoretical arrival time, TAT).
+Tokens are `burst - (TAT - now) / interval` where `interval` is the time it
+takes to earn one, so taking tokens pushes the TAT forward by that many
+intervals, and it is refused if that leaves it more than `burst` intervals
+ahead of now. A TAT in the past is a full bucket.
+
+The TATs are in a `defaultdict(float)` keyed by anything, or with
+`keys=N` for integer keys 0..N-1, in an `array` of doubles, 8 bytes per key.
+
+`bucket(key)` gives a `KeyedBucket`, which passes its `fill` and `deduct`
+calls on to the store with its key, so `fill`, `deduct` and `takeout` take
+it. The stores further down give the same.
+"""
+from array import array
+from collections import defaultdict
+
+
+class KeyedBucket:
+    __slots__ = ('store', 'key')
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def __repr__(self):
+        return f'KeyedBucket(key={self.key!r})'
+
+    def fill(self, amount, now=None):
+        self.store.fill(self.key, amount, now)
+
+    def deduct(self, amount, now=None):
+        return self.store.deduct(self.key, amount, now)
+
+
+class GcraLimiter:
+    def __init__(self, rate, burst, keys=None):
+        self.interval_ns = 1e9 / rate
+        self.tolerance_ns = burst * self.interval_ns
+        if keys is None:
+            self._tats = defaultdict(float)
+        else:
+            self._tats = array('d', bytes(8 * keys))
+
+    def __len__(self):
+        return len(self._tats)
+
+    def bucket(self, key):
+        return KeyedBucket(self, key)
+
+    def deduct(self, key, amount=1, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        tats = self._tats
+        tat = tats[key]
+        if tat < now:
+            tat = now
+        tat += amount * self.interval_ns
+        if tat - now > self.tolerance_ns:
+            return False
+        tats[key] = tat
+        return True
+
+    def fill(self, key, amount, now=None):
+        # Anything before now is a full bucket, no need to stop there.
+        self._tats[key] -= amount * self.interval_ns
+
+    def purge(self, now=None):
+        # Keys with a full bucket are the same as keys never seen.
+        if now is None:
+            now = time.monotonic_ns()
+        tats = self._tats
+        if isinstance(tats, array):
+            return 0
+        full = [key for key, tat in tats.items() if tat <= now]
+        for key in full:
+            del tats[key]
+        return len(full)
+
+
+print()
+print("Per-key limits <GcraLimiter>: 100 per 60 seconds")
+limiter = GcraLimiter(rate=100 / 60, burst=100)
+bucket = limiter.bucket('alice')
+print("First Takeout 99")
+takeout(bucket, 99)
+print("Second Takeout 3")
+takeout(bucket, 3)
+print("Takeout 3 for someone else")
+takeout(limiter.bucket('bob'), 3)
+print(f"Purged {limiter.purge(time.monotonic_ns() + 3 * 60 * SECOND)} keys with a full bucket")
+
+# With 2**20 ns per token and times in steps of 2**10 ns all the floats are
+# exact, so both must decide the same every time.
+import random
+
+rate = 1e9 / 2**20
+limiter = GcraLimiter(rate, burst=8)
+now = time.monotonic_ns()
+buckets = [TokenBucket(rate, burst=8, tokens=8) for _ in range(4)]
+for bucket in buckets:
+    bucket.updated_ns = now
+for _ in range(100_000):
+    now += random.randrange(0, 2**21, 2**10)
+    key = random.randrange(len(buckets))
+    amount = random.randrange(1, 4)
+    if random.random() < 0.1:
+        limiter.fill(key, amount, now)
+        buckets[key].fill(amount, now)
+    else:
+        assert limiter.deduct(key, amount, now) == buckets[key].deduct(amount, now)
+print("GcraLimiter decided the same as TokenBucket 100000 times")
+
+import tracemalloc
+
+keys = 200_000 if BENCH else 20_000
+for label, make in [
+    ("dict of Bucket", lambda: {key: Bucket(60) for key in range(keys)}),
+    ("dict of TokenBucket", lambda: {key: TokenBucket.per_period(60, 100) for key in range(keys)}),
+    ("GcraLimiter dict", lambda: GcraLimiter(100 / 60, 100)),
+    ("GcraLimiter array", lambda: GcraLimiter(100 / 60, 100, keys=keys)),
+]:
+    tracemalloc.start()
+    store = make()
+    if isinstance(store, GcraLimiter):
+        for key in range(keys):
+            store.deduct(key)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {memory / keys:.0f} bytes per key, {memory / keys * 1e7 / 2**30:.2f} GiB for 10M keys")
+    del store
+
+keys = 10_000_000 if BENCH else 200_000
+for label, limiter in [
+    ("GcraLimiter array", GcraLimiter(100 / 60, 100, keys=keys)),
+    ("GcraLimiter dict", GcraLimiter(100 / 60, 100)),
+]:
+    picks = [random.randrange(keys) for _ in range(1_000_000 if BENCH else 200_000)]
+    start = time.perf_counter()
+    decide = limiter.deduct
+    for key in picks:
+        decide(key)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {len(picks) / elapsed / 1e6:.2f} M decisions per second over {keys} keys "
+          f"({len(limiter)} stored)")
+    del limiter
+
+
+"""
+`fill` and `deduct` read the quota and write it back, two threads taking out
+of the same bucket at once can both see the old quota and both get it.
+
+`BucketRegistry` keeps the buckets of every client id and makes each
+`fill`/`deduct` atomic. The ids are spread over shards by their hash, each
+with its own dict and lock, so threads only wait for each other when their
+ids land in the same shard. Buckets that haven't been used for
+`idle_periods` periods are dropped, every shard sweeps itself once every
+`sweep_every` calls, and a bucket asked for again is made anew by `factory`,
+which should make a bucket in the state an idle one would be in by then.
+`now` only dates the use of a bucket, the buckets keep their own time.
+"""
+import sys
+import threading
+
+
+class BucketRegistry:
+    def __init__(self, factory, period, idle_periods=10, shards=16, sweep_every=4096):
+        self.factory = factory
+        self.idle_ns = int(idle_periods * period * SECOND)
+        self.sweep_every = sweep_every
+        self._shards = [{} for _ in range(shards)]  # key -> [bucket, last used ns]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._calls = [0] * shards
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __contains__(self, key):
+        return key in self._shards[hash(key) % len(self._shards)]
+
+    def bucket(self, key):
+        return KeyedBucket(self, key)
+
+    def _use(self, index, key, now):
+        # Called with the lock of the shard held
+        shard = self._shards[index]
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [self.factory(), now]
+        else:
+            entry[1] = now
+        self._calls[index] += 1
+        if self._calls[index] >= self.sweep_every:
+            self._calls[index] = 0
+            self._sweep(shard, now)
+        return entry[0]
+
+    def _sweep(self, shard, now):
+        idle = [key for key, (_, used) in shard.items() if now - used > self.idle_ns]
+        for key in idle:
+            del shard[key]
+        return len(idle)
+
+    def fill(self, key, amount, now=None):
+        index = hash(key) % len(self._shards)
+        if now is None:
+            now = time.monotonic_ns()
+        with self._locks[index]:
+            fill(self._use(index, key, now), amount)
+
+    def deduct(self, key, amount, now=None):
+        index = hash(key) % len(self._shards)
+        if now is None:
+            now = time.monotonic_ns()
+        with self._locks[index]:
+            return deduct(self._use(index, key, now), amount)
+
+    def evict_idle(self, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        evicted = 0
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                evicted += self._sweep(shard, now)
+        return evicted
+
+
+print()
+print("Registry of buckets <BucketRegistry>: 100 per 60 seconds")
+registry = BucketRegistry(lambda: TokenBucket(100 / 60, 100, tokens=100), period=60, idle_periods=2)
+print("First Takeout 99")
+takeout(registry.bucket('alice'), 99)
+print("Second Takeout 3")
+takeout(registry.bucket('alice'), 3)
+takeout(registry.bucket('bob'), 3)
+print(f"{len(registry)} buckets, {registry.evict_idle(time.monotonic_ns() + 60 * SECOND)} idle after a minute, "
+      f"{registry.evict_idle(time.monotonic_ns() + 3 * 60 * SECOND)} idle after three")
+
+
+def hammer(take, keys, attempts, granted, lock):
+    mine = dict.fromkeys(keys, 0)
+    for attempt in range(attempts):
+        key = keys[attempt % len(keys)]
+        if take(key):
+            mine[key] += 1
+    with lock:
+        for key, count in mine.items():
+            granted[key] += count
+
+
+def stress(take, threads=16, keys=50, attempts=20_000):
+    granted = dict.fromkeys(range(keys), 0)
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(target=hammer, args=(take, list(range(keys)), attempts, granted, lock))
+        for _ in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return granted, threads * attempts / (time.perf_counter() - start)
+
+
+# Switch threads as often as possible so the races have a chance to happen.
+interval = sys.getswitchinterval()
+sys.setswitchinterval(1e-6)
+quota = 1000
+try:
+    # Practically no refill during the test, every bucket has `quota` in all.
+    # Whether the unlocked buckets go over depends on where the interpreter
+    # switches threads, with the GIL it's rare, without it it isn't.
+    buckets = {key: TokenBucket(quota / 1e9, quota, tokens=quota) for key in range(50)}
+    granted, _ = stress(lambda key: deduct(buckets[key], 1))
+    print(f"Without locks: {sum(granted.values())} granted out of {50 * quota}, "
+          f"{sum(count > quota for count in granted.values())} buckets over their quota")
+
+    for shards in (1, 16):
+        registry = BucketRegistry(lambda: TokenBucket(quota / 1e9, quota, tokens=quota),
+                                  period=1e9, shards=shards)
+        granted, throughput = stress(lambda key: registry.deduct(key, 1))
+        assert all(count == quota for count in granted.values()), granted
+        print(f"BucketRegistry with {shards} shards: exactly {quota} granted to every bucket, "
+              f"{throughput / 1000:.0f}k decisions per second from 16 threads")
+finally:
+    sys.setswitchinterval(interval)
+
+registry = BucketRegistry(lambda: TokenBucket(1, 1, tokens=1), period=1, idle_periods=1, sweep_every=10)
+for key in range(1000):
+    registry.deduct(key, 1)
+time.sleep(1.1)
+registry.deduct('late', 1)
+for key in range(200):
+    registry.deduct(key, 1)
+print(f"After a second idle the automatic sweeps left {len(registry)} of 1001 buckets")
+assert len(registry) < 1001
+
+
+"""
+`deduct` can only say no, callers then have to retry or guess how long to
+sleep. `AsyncTokenBucket.acquire(amount, timeout)` waits instead: the
+coroutines that can't have their tokens yet queue up in the bucket, and they
+are served strictly in order, so a big request at the head isn't overtaken
+by small ones (`deduct` also says no while anyone is queued). The time at
+which the head has enough tokens is worked out from the rate, and the bucket
+asks to be woken up exactly then.
+
+All the buckets of an event loop share one `_TimerHeap`, a heap of wake up
+times and timeouts with a single `call_later` for the earliest one, so
+thousands of waiting coroutines don't each have a timer in the loop.
+Cancelled entries are left in the heap until they come up, or until they are
+more than half of it and the heap is rebuilt without them.
+`acquire` returns True once it has the tokens and False if the timeout runs
+out first.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import math
+import weakref
+
+
+class _TimerHeap:
+    def __init__(self, loop):
+        self.loop = loop
+        self.entries = []  # [when ns, tiebreaker, callback or None if cancelled]
+        self._cancelled = 0
+        self._tiebreaker = itertools.count()
+        self._handle = None
+        self._handle_ns = None
+
+    def call_at_ns(self, when_ns, callback):
+        entry = [when_ns, next(self._tiebreaker), callback]
+        heapq.heappush(self.entries, entry)
+        if self._handle_ns is None or when_ns < self._handle_ns:
+            self._arm(when_ns)
+        return entry
+
+    def cancel(self, entry):
+        if entry[2] is None:
+            return  # Already cancelled or run
+        entry[2] = None
+        self._cancelled += 1
+        if self._cancelled * 2 > len(self.entries):
+            # In place, _run may be popping from this list
+            self.entries[:] = [entry for entry in self.entries if entry[2] is not None]
+            heapq.heapify(self.entries)
+            self._cancelled = 0
+
+    def _arm(self, when_ns):
+        if self._handle is not None:
+            self._handle.cancel()
+        delay = max(0, when_ns - time.monotonic_ns()) / 1e9
+        self._handle = self.loop.call_later(delay, self._run)
+        self._handle_ns = when_ns
+
+    def _run(self):
+        self._handle = self._handle_ns = None
+        entries = self.entries
+        now = time.monotonic_ns()
+        while entries and (entries[0][0] <= now or entries[0][2] is None):
+            entry = heapq.heappop(entries)
+            callback = entry[2]
+            if callback is None:
+                self._cancelled -= 1
+            else:
+                entry[2] = None
+                callback(now)
+        if entries:
+            self._arm(entries[0][0])
+
+
+_timer_heaps = weakref.WeakKeyDictionary()
+
+
+def _timer_heap(loop):
+    timers = _timer_heaps.get(loop)
+    if timers is None:
+        timers = _timer_heaps[loop] = _TimerHeap(loop)
+    return timers
+
+
+class AsyncTokenBucket(TokenBucket):
+    __slots__ = ('_waiters', '_wake', '_timers')
+
+    def __init__(self, rate, burst, tokens=0):
+        super().__init__(rate, burst, tokens)
+        self._waiters = collections.deque()  # (amount, future)
+        self._wake = None
+        self._timers = None
+
+    def fill(self, amount, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        super().fill(amount, now)
+        if self._waiters:
+            self._serve(now)
+
+    def deduct(self, amount, now=None):
+        if self._waiters:
+            return False  # The queued coroutines go first
+        return super().deduct(amount, now)
+
+    async def acquire(self, amount=1, timeout=None):
+        if amount > self.burst:
+            raise ValueError(f"Can't ever have {amount} tokens with a burst of {self.burst}")
+        if not self._waiters and TokenBucket.deduct(self, amount):
+            return True
+        if timeout is not None and timeout <= 0:
+            return False
+
+        loop = asyncio.get_running_loop()
+        self._timers = _timer_heap(loop)
+        future = loop.create_future()
+        self._waiters.append((amount, future))
+        if len(self._waiters) == 1:
+            self._serve(time.monotonic_ns())
+
+        def expire(now):
+            if not future.done():
+                future.set_result(False)
+                self._serve(now)  # The ones behind may go now
+
+        deadline = None
+        if timeout is not None:
+            deadline = self._timers.call_at_ns(time.monotonic_ns() + int(timeout * 1e9), expire)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            now = time.monotonic_ns()
+            if future.done() and not future.cancelled() and future.result():
+                # Granted just before the cancel landed, give the tokens back
+                TokenBucket.fill(self, amount, now)
+            self._serve(now)
+            raise
+        finally:
+            if deadline is not None:
+                self._timers.cancel(deadline)
+
+    def _serve(self, now):
+        waiters = self._waiters
+        while waiters:
+            amount, future = waiters[0]
+            if future.done():
+                waiters.popleft()  # Timed out or cancelled
+                continue
+            if not TokenBucket.deduct(self, amount, now):
+                break
+            waiters.popleft()
+            future.set_result(True)
+
+        if self._wake is not None:
+            self._timers.cancel(self._wake)
+            self._wake = None
+        if waiters and self.rate_per_ns > 0:
+            missing = waiters[0][0] - self.tokens
+            self._wake = self._timers.call_at_ns(
+                now + math.ceil(missing / self.rate_per_ns), self._serve)
+
+
+async def async_buckets():
+    bucket = AsyncTokenBucket(rate=100, burst=10)
+    start = time.perf_counter()
+    served = []
+
+    async def ask(name, amount, timeout=None):
+        granted = await bucket.acquire(amount, timeout)
+        served.append((name, granted, round((time.perf_counter() - start) * 1000)))
+
+    await asyncio.gather(
+        ask('a', 5), ask('b', 10), ask('c', 1), ask('d', 1), ask('e', 1, timeout=0.03))
+    print("Served in order (name, granted, ms):", served)
+    assert [name for name, _, _ in served] == ['e', 'a', 'b', 'c', 'd']
+    assert served[0][1] is False
+
+    # Cancelled after the tokens were granted but before it got to run
+    bucket = AsyncTokenBucket(rate=0, burst=3)
+    task = asyncio.ensure_future(bucket.acquire(2))
+    await asyncio.sleep(0)
+    bucket.fill(3)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert task.cancelled() and bucket.quota == 3
+
+    buckets = [AsyncTokenBucket(rate=100, burst=5) for _ in range(100)]
+    waiting = 5000
+    grants = collections.defaultdict(list)
+
+    async def take(bucket):
+        await bucket.acquire(1)
+        grants[bucket].append(time.perf_counter())
+
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(take(buckets[number % len(buckets)])) for number in range(waiting)]
+    await asyncio.sleep(0)
+    timers = _timer_heap(asyncio.get_running_loop())
+    print(f"{waiting} coroutines waiting on {len(buckets)} buckets, "
+          f"{len(timers.entries)} entries in the shared timer heap")
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    # Every wait below cancels a timeout 60 s away, they mustn't pile up
+    bucket = AsyncTokenBucket(rate=1000, burst=1)
+    for _ in range(200):
+        assert await bucket.acquire(1, timeout=60)
+    assert len(timers.entries) < 10
+
+    # Once the waiters have taken the tokens saved up while they were being
+    # queued, every bucket earns one every 10 ms and the next waiter should
+    # get it right then.
+    gaps = []
+    for times in grants.values():
+        times = times[10:]
+        gaps.extend(after - before for before, after in zip(times, times[1:]))
+    # The loop sleeps in steps of 1 ms, a wake up can be that late, but the
+    # next one is worked out from the tokens so it doesn't add up.
+    gaps.sort()
+    print(f"All served in {elapsed * 1000:.0f} ms, time between grants of a bucket: "
+          f"mean {sum(gaps) / len(gaps) * 1000:.2f} ms, 1% {gaps[len(gaps) // 100] * 1000:.2f} ms, "
+          f"99% {gaps[len(gaps) * 99 // 100] * 1000:.2f} ms")
+
+
+print()
+print("Waiting for quota <AsyncTokenBucket>: 100 per second, bursts of 10")
+asyncio.run(async_buckets())
+
+
+"""
+Every process of a pre-forked server has its own buckets, so the real limit
+is the one configured times the number of processes.
+
+`SharedBucketStore` keeps the buckets in a `multiprocessing.shared_memory`
+block that the processes forked after it see too, one fixed-size record per
+bucket: quota, consumed, time of the last reset and period, all 64 bit ints
+in nanoseconds of `time.monotonic_ns()`, which is the same clock for every
+process on the machine. They work like `NewBucket` does: `fill` starts a new
+period with a new quota once the old one has run out and `deduct` takes from
+it. Reading and writing a record happens under one of `stripes`
+`multiprocessing.Lock`s, picked by the slot of the bucket. The locks can only
+be handed down by forking, so the store must be made before the workers.
+Buckets are numbered 0..slots-1.
+"""
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+_BUCKET_RECORD = struct.Struct('<qqqq')  # quota, consumed, reset ns, period ns
+_CONSUMED = struct.Struct('<q')
+
+
+class SharedBucketStore:
+    def __init__(self, slots, period, stripes=64):
+        self.slots = slots
+        self._memory = shared_memory.SharedMemory(create=True, size=slots * _BUCKET_RECORD.size)
+        self._buffer = self._memory.buf
+        self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+        period_ns = int(period * SECOND)
+        for slot in range(slots):
+            # Never filled, its last period is long over
+            _BUCKET_RECORD.pack_into(self._buffer, slot * _BUCKET_RECORD.size,
+                                     0, 0, -period_ns - 1, period_ns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        self.unlink()
+
+    def close(self):
+        self._buffer = None
+        self._memory.close()
+
+    def unlink(self):
+        self._memory.unlink()
+
+    def bucket(self, slot):
+        if not 0 <= slot < self.slots:
+            raise IndexError(f"Slot {slot} is out of range")
+        return KeyedBucket(self, slot)
+
+    def record(self, slot):
+        with self._locks[slot % len(self._locks)]:
+            return _BUCKET_RECORD.unpack_from(self._buffer, slot * _BUCKET_RECORD.size)
+
+    def fill(self, slot, amount, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        offset = slot * _BUCKET_RECORD.size
+        with self._locks[slot % len(self._locks)]:
+            quota, consumed, reset_ns, period_ns = _BUCKET_RECORD.unpack_from(self._buffer, offset)
+            if now - reset_ns > period_ns:
+                quota, consumed, reset_ns = 0, 0, now
+            _BUCKET_RECORD.pack_into(self._buffer, offset, quota + amount, consumed, reset_ns, period_ns)
+
+    def deduct(self, slot, amount, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        offset = slot * _BUCKET_RECORD.size
+        with self._locks[slot % len(self._locks)]:
+            quota, consumed, reset_ns, period_ns = _BUCKET_RECORD.unpack_from(self._buffer, offset)
+            if now - reset_ns > period_ns:
+                return False  # Bucket hasn't been filled this period
+            if quota - consumed < amount:
+                return False  # Bucket was filled but not enough
+            _CONSUMED.pack_into(self._buffer, offset + 8, consumed + amount)
+            return True
+
+
+def _take_shared(store, slots, attempts, results):
+    granted = [0] * slots
+    for attempt in range(attempts):
+        slot = attempt % slots
+        if store.deduct(slot, 1):
+            granted[slot] += 1
+    results.put(granted)
+
+
+def shared_stress(store, processes, slots, attempts):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_take_shared, args=(store, slots, attempts, results))
+               for _ in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    granted = [sum(counts) for counts in zip(*(results.get() for _ in workers))]
+    for worker in workers:
+        worker.join()
+    return granted, processes * attempts / (time.perf_counter() - start)
+
+
+print()
+print("Shared between processes <SharedBucketStore>: 100 per 60 seconds")
+with SharedBucketStore(slots=1000, period=60) as store:
+    bucket = store.bucket(7)
+    fill(bucket, 100)
+    quota, consumed, _, _ = store.record(7)
+    print(f"{bucket}: quota={quota}, consumed={consumed}")
+    print("First Takeout 99")
+    takeout(bucket, 99)
+    print("Second Takeout 3")
+    takeout(bucket, 3)
+
+    start = time.perf_counter_ns()
+    for attempt in range(100_000):
+        store.deduct(attempt % 1000, 1)
+    print(f"One process: {(time.perf_counter_ns() - start) / 100_000:.0f} ns per decision")
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        print("Can't fork here, skipping the processes")
+    else:
+        quota, slots = 2000, 10
+        for slot in range(slots):
+            fill(store.bucket(slot), quota)
+        granted, throughput = shared_stress(store, processes=4, slots=slots, attempts=20_000)
+        assert granted == [quota] * slots, granted
+        print(f"4 processes, {slots} buckets of {quota}: exactly {quota} granted from each, "
+              f"{throughput / 1000:.0f}k decisions per second in all ({os.cpu_count()} CPUs)")